@@ -39,7 +39,8 @@ from curriculum.experiments.asym_selfplay.envs.alice_env import AliceEnv
 from curriculum.state.evaluator import parallel_map, FunctionWrapper
 from curriculum.state.utils import StateCollection
 from curriculum.logging.visualization import plot_labeled_states, plot_labeled_samples
-from curriculum.state.evaluator import FunctionWrapper, parallel_map
+from curriculum.state.evaluator import FunctionWrapper, parallel_map, persistent_map
+from rllab.sampler import parallel_sampler
 from rllab.sampler.stateful_pool import singleton_pool
 
 
@@ -197,13 +198,25 @@ def generate_starts_alice(env_alice, algo_alice, log_dir, start_states=None, num
 
 
 def generate_starts(env, policy=None, starts=None, horizon=50, size=10000, subsample=None, variance=1,
-                    zero_action=False, animated=False, speedup=1):
-    """ If policy is None, brownian motion applied """
+                    zero_action=False, animated=False, speedup=1, check_feasible=False, feasibility_path_length=50):
+    """
+    If policy is None, brownian motion applied
+    :param check_feasible: only keep the states passing check_feasibility; the check is run by the workers right after
+    the rollouts generating the states, so size still counts the states before the check
+    """
     if starts is None or len(starts) == 0:
         starts = [env.reset()]
     print("the starts from where we generate more is of len: ", len(starts))
     if horizon <= 1:
         states = starts  # you better give me some starts if there is no horizon!
+    elif not animated:
+        states, stats = collect_brownian_starts(env, starts, size, policy=policy, horizon=horizon, variance=variance,
+                                                feasibility_path_length=feasibility_path_length if check_feasible
+                                                else None)
+        logger.log("Generating starts, rollouts that reached goal: {} out of {}".format(stats['n_reached_goal'],
+                                                                                      stats['n_rollouts']))
+        if check_feasible:
+            logger.log("Infeasible starts rejected: {} out of {}".format(stats['n_rejected'], stats['n_states']))
     else:
         n_starts = len(starts)
         i = 0
@@ -214,85 +227,117 @@ def generate_starts(env, policy=None, starts=None, horizon=50, size=10000, subsa
         num_roll_reached_goal = 0
         num_roll = 0
         goal_reached = False
-        # if animated:
-        #     env.render()
+        # env.render()
         while len(states) < size:
-            if animated:
-                steps += 1
-                if done or steps >= horizon:
-                    i += 1
-                    steps = 0
-                    done = False
-                    obs = env.reset(init_state=starts[i % n_starts])
-                    # import pdb; pdb.set_trace()
-                    states.append(env.start_observation)
-                    num_roll += 1
-                    if goal_reached:
-                        num_roll_reached_goal += 1
-                else:
-                    noise = np.random.uniform(*env.action_space.bounds)
-                    if policy:
-                        action, _ = policy.get_action(obs)
-                    else:
-                        action = noise
-                    if zero_action:
-                        action = np.zeros_like(action)
-                    obs, _, done, env_info = env.step(action)
-                    states.append(env.start_observation)
-                    if done and env_info['goal_reached']:  # we don't care about goal done, otherwise will never advance!
-                        goal_reached = True
-                        done = False
-                # env.render()
-                # timestep = 0.05
-                # time.sleep(timestep / speedup)
-            else:
+            steps += 1
+            if done or steps >= horizon:
+                i += 1
+                steps = 0
+                done = False
+                obs = env.reset(init_state=starts[i % n_starts])
                 # import pdb; pdb.set_trace()
-                brownian_state_wrapper = FunctionWrapper(
-                    brownian,
-                    env=env,
-                    kill_outside=env.kill_outside,
-                    kill_radius=env.kill_radius,  # this should be set before passing the env to generate_starts
-                    horizon=horizon,
-                    variance=variance,
-                    policy=policy,
-                )
-                parallel_starts = [starts[j % n_starts] for j in range(i,i+singleton_pool.n_parallel)]
-                # print("parallel sampling from :", parallel_starts)
-                i += singleton_pool.n_parallel
-                results = parallel_map(brownian_state_wrapper, parallel_starts)
-                new_states = np.concatenate([result[0] for result in results])
-
-                # show where these states are:
-                np.random.shuffle(new_states)  # todo: this has a prety big impoact!! Why?? (related to collection)
-                # generate_starts(env, starts=new_states, horizon=10, variance=0,
-                #                 zero_action=True, animated=True, speedup=10, size=100)
-
-                print('Just collected {} rollouts, with {} states'.format(len(results), new_states.shape))
-                states.extend(new_states.tolist())
-                print('now the states are of len: ', len(states))
-                num_roll_reached_goal += np.sum([result[1] for result in results])
-                print("num_roll_reached_goal ",  np.sum([result[1] for result in results]))
-                num_roll += len(results)
+                states.append(env.start_observation)
+                num_roll += 1
+                if goal_reached:
+                    num_roll_reached_goal += 1
+            else:
+                noise = np.random.uniform(*env.action_space.bounds)
+                if policy:
+                    action, _ = policy.get_action(obs)
+                else:
+                    action = noise
+                if zero_action:
+                    action = np.zeros_like(action)
+                obs, _, done, env_info = env.step(action)
+                states.append(env.start_observation)
+                if done and env_info['goal_reached']:  # we don't care about goal done, otherwise will never advance!
+                    goal_reached = True
+                    done = False
+            # env.render()
+            # timestep = 0.05
+            # time.sleep(timestep / speedup)
         logger.log("Generating starts, rollouts that reached goal: " + str(num_roll_reached_goal) + " out of " + str(num_roll))
+    if not isinstance(states, np.ndarray):
+        states = np.stack([np.array(state) for state in states])
+    if check_feasible and (horizon <= 1 or animated):
+        # the brownian rollouts of the workers are already filtered
+        states = parallel_check_feasibility(states, env, max_path_length=feasibility_path_length)
     logger.log("Starts generated.")
-    if subsample is None:
-        return np.stack([np.array(state) for state in states])
+    if subsample is None or len(states) < subsample:
+        return states
+    return states[np.random.choice(np.shape(states)[0], size=subsample)]
+
+
+def collect_brownian_starts(env, starts, size, policy=None, horizon=50, variance=1, feasibility_path_length=None,
+                            scope=None):
+    """
+    Run brownian rollouts from seed starts drawn at random among starts until at least size states are generated.
+    With a worker pool, each worker keeps running rollouts on the env it holds, and they all stop as soon as the
+    total number of states reaches size; the states of a worker are only sent back once, at the end.
+    :param feasibility_path_length: if not None, the states of each rollout are filtered with check_feasibility on
+    the same env before being sent back
+    :param scope: scope of the env and policy on the workers; defaults to the one of persistent_map
+    :return: array of the generated (feasible) states, shuffled, and a dict with the number of rollouts, of rollouts
+    that reached the goal, of generated states and of states rejected by the feasibility check
+    """
+    starts = np.asarray(starts)
+    brownian_kwargs = dict(kill_outside=env.kill_outside,
+                           kill_radius=env.kill_radius,  # this should be set before passing the env to generate_starts
+                           horizon=horizon, variance=variance)
+    if singleton_pool.n_parallel > 1:
+        if scope is None:
+            scope = 'persistent_map' if policy is not None else 'persistent_map_env'
+        parallel_sampler.populate_task(env, policy, scope=scope, refresh=True)
+        results = singleton_pool.run_collect(
+            _worker_collect_brownian,
+            threshold=size,
+            args=(starts, brownian_kwargs, feasibility_path_length, policy is not None, scope),
+            show_prog_bar=False,
+        )
     else:
-        states = np.stack([np.array(state) for state in states])
-        if len(states) < subsample:
-            return states
-        return states[np.random.choice(np.shape(states)[0], size=subsample)]
+        results = []
+        n_states = 0
+        while n_states < size:
+            result, n_new_states = _collect_brownian(starts, env, policy, brownian_kwargs, feasibility_path_length)
+            results.append(result)
+            n_states += n_new_states
+    states = np.concatenate([result[0] for result in results])
+    # todo: this has a prety big impoact!! Why?? (related to collection)
+    np.random.shuffle(states)
+    stats = dict(
+        n_rollouts=len(results),
+        n_reached_goal=int(np.sum([result[1] for result in results])),
+        n_states=int(np.sum([len(result[0]) + result[2] for result in results])),
+        n_rejected=int(np.sum([result[2] for result in results])),
+    )
+    return states, stats
+
+
+def _collect_brownian(starts, env, policy, brownian_kwargs, feasibility_path_length=None):
+    start = starts[np.random.randint(len(starts))]
+    states, goal_reached = brownian(start, env, policy=policy, **brownian_kwargs)
+    states = np.asarray(states)
+    n_states = len(states)
+    if feasibility_path_length is not None:
+        is_feasible = np.array([check_feasibility(state, env, max_path_length=feasibility_path_length)
+                                for state in states], dtype=bool)
+        states = states[is_feasible]
+    return (states, goal_reached, n_states - len(states)), n_states
+
+
+def _worker_collect_brownian(G, starts, brownian_kwargs, feasibility_path_length, with_policy, scope):
+    G = parallel_sampler._get_scoped_G(G, scope)
+    return _collect_brownian(starts, G.env, G.policy if with_policy else None, brownian_kwargs,
+                             feasibility_path_length)
+
 
 def parallel_check_feasibility(starts, env, max_path_length=50, n_processes=-1):
-    feasibility_wrapper = FunctionWrapper(
+    is_feasible = persistent_map(
         check_feasibility,
-        env =env,
-        max_path_length=max_path_length,
-    )
-    is_feasible = parallel_map(
-        feasibility_wrapper,
         starts,
-        n_processes,
+        env,
+        n_processes=n_processes,
+        max_path_length=max_path_length,
     )
     #TODO: is there better way to do this?
     result = [starts[i] for i in range(len(starts)) if is_feasible[i]] # keep starts that are feasible only
@@ -378,13 +423,12 @@ def find_all_feasible_states_plotting(env, seed_starts, report, distance_thresho
             if len(added_states) > 0:
                 while len(starts) < 1.5 * num_samples:
                     starts = np.concatenate((starts, added_states), axis=0)
+        # filters starts so that we only keep the good starts (used for ant maze environment, where we ant to run
+        # no_action), see generate_starts
         new_starts = generate_starts(env, starts=starts, horizon=horizon, size=size, variance=brownian_variance,
-                                     animated=animate, speedup=50)
-        # filters starts so that we only keep the good starts
-        if check_feasible: # used for ant maze environment, where we ant to run no_action
-            logger.log("Prefilteredstarts: {}".format(len(new_starts)))
-            new_starts = parallel_check_feasibility(env=env, starts=new_starts, max_path_length=check_feasible_path_length)
-            # new_starts = [start for start in new_starts if check_feasibility(env, start, check_feasible_path_length)]
+                                     animated=animate, speedup=50, check_feasible=check_feasible,
+                                     feasibility_path_length=check_feasible_path_length)
+        if check_feasible:
             logger.log("Filtered starts: {}".format(len(new_starts)))
         all_starts_samples = all_feasible_starts.sample(num_samples)
         added_states = all_feasible_starts.append(new_starts)
@@ -392,8 +436,8 @@ def find_all_feasible_states_plotting(env, seed_starts, report, distance_thresho
         logger.log("number of new states: " + str(num_new_starts))
         if num_new_starts < 3:
             no_new_states += 1
-        with open(osp.join(log_dir, 'all_feasible_states.pkl'), 'wb') as f:
-            cloudpickle.dump(all_feasible_starts, f, protocol=3)
+        # only writes the new states, see load_state_collection
+        all_feasible_starts.checkpoint(osp.join(log_dir, 'all_feasible_states'))
 
 
         # want to plot added_states and old sampled starts
@@ -424,6 +468,8 @@ def find_all_feasible_states_plotting(env, seed_starts, report, distance_thresho
     report.add_image(img, 'itr: {}\n'.format(iteration), width=500)
     report.add_text("Total number of states: " + str(all_feasible_starts.size))
     report.save()
+    with open(osp.join(log_dir, 'all_feasible_states.pkl'), 'wb') as f:
+        cloudpickle.dump(all_feasible_starts, f, protocol=3)
 
 
 def brownian(start, env, kill_outside, kill_radius, horizon, variance, policy=None):
@@ -465,7 +511,7 @@ def find_all_feasible_states(env, seed_starts, distance_threshold=0.1, brownian_
         total_num_starts = all_feasible_starts.size
         if max_states is not None:
             if total_num_starts > max_states:
-                return
+                break
         starts = all_feasible_starts.sample(100)
         new_starts = generate_starts(env, starts=starts, horizon=horizon, size=10000, variance=brownian_variance,
                                      animated=animate, speedup=speedup)
@@ -475,8 +521,11 @@ def find_all_feasible_states(env, seed_starts, distance_threshold=0.1, brownian_
         logger.log("number of new states: {}, total_states: {}".format(num_new_starts, all_feasible_starts.size))
         if num_new_starts < 10:
             no_new_states += 1
-        with open(osp.join(log_dir, 'all_feasible_states.pkl'), 'wb') as f:
-            cloudpickle.dump(all_feasible_starts, f, protocol=3)
+        # only writes the new states, see load_state_collection
+        all_feasible_starts.checkpoint(osp.join(log_dir, 'all_feasible_states'))
+    # the pickle is kept for the experiments loading it
+    with open(osp.join(log_dir, 'all_feasible_states.pkl'), 'wb') as f:
+        cloudpickle.dump(all_feasible_starts, f, protocol=3)
 
 
 def find_all_feasible_reject_states(env, distance_threshold=0.1,):
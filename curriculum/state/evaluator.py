@@ -2,11 +2,14 @@ import multiprocessing
 import os
 import tempfile
 import numpy as np
+import scipy.stats
 from collections import OrderedDict
 import cloudpickle
+import hashlib
 import time
 
-from rllab.sampler.utils import rollout
+from rllab.sampler.path_batch import PathBatch
+from rllab.sampler.utils import rollout, vectorized_rollout, get_path_info
 from rllab.misc import logger
 
 from curriculum.envs.base import FixedStateGenerator
@@ -51,21 +54,38 @@ def disable_cuda_initializer(*args, **kwargs):
     os.environ['CUDA_VISIBLE_DEVICES'] = ''
 
 
+def _split(objects, n_chunks):
+    chunk_size = int(np.ceil(len(objects) / max(n_chunks, 1)))
+    return [objects[i:i + chunk_size] for i in range(0, len(objects), chunk_size)]
+
+
+def _worker_map_chunk(G, func, objects):
+    return [func(x) for x in objects]
+
+
 def parallel_map(func, iterable_object, num_processes=-1):
     """Parallelized map function based on python process
     Args:
     func: Pickleable callable object that takes one parameter.
     iterable_object: An iterable of elements to map the function on.
     num_processes: Number of process to use. When num_processes is 1,
-                   no new process will be created.
+                   no new process will be created. When it is -1 or the number of workers of the
+                   sampler pool, the workers of the sampler pool are used.
     Returns:
     The list resulted in calling the func on all objects in the original list.
     """
     if num_processes == 1:
         return [func(x) for x in iterable_object]
+    from rllab.sampler.stateful_pool import singleton_pool
     if num_processes == -1:
-        from rllab.sampler.stateful_pool import singleton_pool
         num_processes = singleton_pool.n_parallel
+    if num_processes == singleton_pool.n_parallel > 1:
+        # func is sent once per chunk, like multiprocessing.Pool.map does
+        chunks = singleton_pool.run_map(
+            _worker_map_chunk,
+            [(func, chunk) for chunk in _split(list(iterable_object), 4 * num_processes)]
+        )
+        return [result for chunk in chunks for result in chunk]
     process_pool = multiprocessing.Pool(
         num_processes,
         initializer=disable_cuda_initializer
@@ -75,6 +95,57 @@ def parallel_map(func, iterable_object, num_processes=-1):
     process_pool.join()
     return results
 
+
+def _worker_persistent_map_chunk(G, func, objects, kwargs, with_policy, scope):
+    from rllab.sampler.parallel_sampler import _get_scoped_G
+    func = cloudpickle.loads(func)
+    G = _get_scoped_G(G, scope)
+    if with_policy:
+        kwargs = dict(kwargs, env=G.env, policy=G.policy)
+    else:
+        kwargs = dict(kwargs, env=G.env)
+    return [func(x, **kwargs) for x in objects]
+
+
+def persistent_map(func, iterable_object, env, policy=None, n_processes=-1, scope=None, **kwargs):
+    """Map func(x, env=env, policy=policy, **kwargs) over the objects with the workers of the sampler pool.
+    Unlike parallel_map with a FunctionWrapper, the env and the policy are not sent with the tasks: the workers keep
+    them between calls in a scope of their own (see parallel_sampler.populate_task), and only their start/goal
+    generators and the policy parameters are pushed to the workers at each call.
+    Args:
+    policy: if None, func is called without a policy argument.
+    n_processes: 1 to run in this process; -1 or the number of workers of the sampler pool to use its workers;
+                 any other number of processes is handled by parallel_map, which sends the env and the policy with
+                 the tasks.
+    scope: defaults to a scope shared by the calls with a policy, and another one for the calls without.
+    kwargs: additional arguments of func, sent with each chunk of objects, so they should be small.
+    Returns:
+    The list resulted in calling the func on all objects in the original list.
+    """
+    from rllab.sampler.stateful_pool import singleton_pool
+    from rllab.sampler import parallel_sampler
+    if policy is not None:
+        wrapper_kwargs = dict(kwargs, env=env, policy=policy)
+    else:
+        wrapper_kwargs = dict(kwargs, env=env)
+    if n_processes == 1:
+        return [func(x, **wrapper_kwargs) for x in iterable_object]
+    if n_processes != -1 and n_processes != singleton_pool.n_parallel:
+        return parallel_map(FunctionWrapper(func, **wrapper_kwargs), iterable_object, n_processes)
+    if singleton_pool.n_parallel <= 1:
+        return [func(x, **wrapper_kwargs) for x in iterable_object]
+    if scope is None:
+        scope = 'persistent_map' if policy is not None else 'persistent_map_env'
+    parallel_sampler.populate_task(env, policy, scope=scope, refresh=True)
+    func = cloudpickle.dumps(func)
+    chunks = singleton_pool.run_map(
+        _worker_persistent_map_chunk,
+        [(func, chunk, kwargs, policy is not None, scope)
+         for chunk in _split(list(iterable_object), 4 * singleton_pool.n_parallel)]
+    )
+    return [result for chunk in chunks for result in chunk]
+
+
 def compute_rewards_from_paths(all_paths, key='rewards', as_goal=True, env=None, terminal_eps=0.1):
     all_rewards = []
     all_states = []
@@ -82,7 +153,7 @@ def compute_rewards_from_paths(all_paths, key='rewards', as_goal=True, env=None,
         for path in paths:
             if key == 'competence':
                 #goal = tuple(path['env_infos']['goal'][0])
-                goal_np_array = np.array(tuple(path['env_infos']['goal'][0]))
+                goal_np_array = np.array(tuple(get_path_info(path, 'goal')))
                 start_state = np.array(tuple(env.transform_to_goal_space(path['observations'][0])))
                 end_state = np.array(tuple(env.transform_to_goal_space(path['observations'][-1])))
                 final_dist = np.linalg.norm(goal_np_array - end_state)
@@ -98,7 +169,7 @@ def compute_rewards_from_paths(all_paths, key='rewards', as_goal=True, env=None,
                 reward = evaluate_path(path, key=key)
 
             if as_goal:
-                state = tuple(path['env_infos']['goal'][0])
+                state = tuple(get_path_info(path, 'goal'))
             else:
                 state = tuple(env.transform_to_start_space(path['observations'][0]))
 
@@ -108,22 +179,80 @@ def compute_rewards_from_paths(all_paths, key='rewards', as_goal=True, env=None,
     return [all_states, all_rewards]
 
 
+class StateRewardAccumulator(object):
+    """
+    Keeps the reward of each path per goal (as_goal) or start, which is all label_states_from_paths needs, so that
+    the paths themselves can be dropped. Use it as the path_summarizer of BatchPolopt, and pass it to
+    label_states_from_paths in place of the paths returned by train.
+    """
+
+    def __init__(self, key='rewards', as_goal=True, env=None):
+        self.key = key
+        self.as_goal = as_goal
+        self.env = env
+        self.state_rewards = OrderedDict()
+
+    def __call__(self, itr, paths):
+        self.add_paths(paths)
+
+    def add_paths(self, paths):
+        if isinstance(paths, PathBatch):
+            rewards, states = self._batch_rewards_and_states(paths)
+        else:
+            rewards, states = [None] * len(paths), [None] * len(paths)
+        for path, reward, state in zip(paths, rewards, states):
+            if reward is None:
+                reward = evaluate_path(path, key=self.key)
+            if state is None:
+                if self.as_goal:
+                    state = tuple(get_path_info(path, 'goal'))
+                else:
+                    env_infos_first_time_step = {key: value[0] for key, value in path['env_infos'].items()}
+                    state = tuple(self.env.transform_to_start_space(path['observations'][0],
+                                                                    env_infos_first_time_step))
+            if state in self.state_rewards:
+                self.state_rewards[state].append(reward)
+            else:
+                self.state_rewards[state] = [reward]
+
+
+    def _batch_rewards_and_states(self, paths):
+        """
+        Rewards and goals of all the paths of a PathBatch computed on its columns at once, or None for the paths
+        that must go through evaluate_path and transform_to_start_space.
+        """
+        n_paths = len(paths)
+        env_infos = paths.columns.get('env_infos', dict())
+        column = paths.columns.get(self.key, env_infos.get(self.key, None))
+        if column is not None and column.ndim == 1 and np.all(paths.path_lengths > 0):
+            # np.add.reduceat keeps the dtype of the column (a logical or for bools), unlike the np.sum of
+            # evaluate_path, which upcasts bools and small integers
+            column = column.astype(np.sum(column[:0]).dtype, copy=False)
+            rewards = list(paths.reduce_per_path(column))
+        else:
+            rewards = [None] * n_paths
+        if self.as_goal and 'goal' in env_infos and n_paths > 0:
+            states = [tuple(goal) for goal in paths.first_steps(env_infos['goal'])]
+        else:
+            states = [None] * n_paths
+        return rewards, states
+
+
 def label_states_from_paths(all_paths, min_reward=0, max_reward=1, key='rewards', as_goal=True,
                  old_rewards=None, improvement_threshold=0, n_traj=1, env=None, return_mean_rewards = False,
                             order_of_states = None):
-    state_dict = {}
-    for paths in all_paths:
-        for path in paths:
-            reward = evaluate_path(path, key=key)
-            if as_goal:
-                state = tuple(path['env_infos']['goal'][0])
-            else:
-                env_infos_first_time_step = {key: value[0] for key, value in path['env_infos'].items()}
-                state = tuple(env.transform_to_start_space(path['observations'][0], env_infos_first_time_step))
-            if state in state_dict:
-                state_dict[state].append(reward)
-            else:
-                state_dict[state] = [reward]
+    """
+    :param all_paths: list of lists of paths, or a StateRewardAccumulator built with the same key and as_goal
+    """
+    if isinstance(all_paths, StateRewardAccumulator):
+        assert all_paths.key == key and all_paths.as_goal == as_goal, \
+            "the accumulator was built for another key or state type"
+        accumulator = all_paths
+    else:
+        accumulator = StateRewardAccumulator(key=key, as_goal=as_goal, env=env)
+        for paths in all_paths:
+            accumulator.add_paths(paths)
+    state_dict = accumulator.state_rewards
 
     states = []
     unlabeled_state = []
@@ -161,11 +290,32 @@ def label_states_from_paths(all_paths, min_reward=0, max_reward=1, key='rewards'
 
 
 def label_states(states, env, policy, horizon, as_goals=True, min_reward=0.1, max_reward=0.9, key='rewards',
-                 old_rewards=None, improvement_threshold=0.1, n_traj=1, n_processes=-1, full_path=False, return_rew=False):
+                 old_rewards=None, improvement_threshold=0.1, n_traj=1, n_processes=-1, full_path=False, return_rew=False,
+                 lockstep=False, n_envs=32, adaptive=False, bound=None, confidence=0.95, reward_range=None,
+                 cache=None):
+    """
+    :param cache: optional EvaluationCache (see evaluate_states); not used by the adaptive labeling
+    :param adaptive: stop running rollouts for a state once its label is settled (see evaluate_states_adaptive, which
+    also describes bound, confidence and reward_range). Not supported with full_path.
+    """
     logger.log("Labelling starts")
+    if adaptive:
+        assert not full_path, "full_path is not supported by the adaptive labeling"
+        labels, mean_rewards, n_rollouts, n_saved = evaluate_states_adaptive(
+            states, env, policy, horizon, n_traj=n_traj, min_reward=min_reward, max_reward=max_reward,
+            old_rewards=old_rewards, improvement_threshold=improvement_threshold, key=key, as_goals=as_goals,
+            n_processes=n_processes, bound=bound, confidence=confidence, reward_range=reward_range,
+            lockstep=lockstep, n_envs=n_envs,
+        )
+        logger.log("Starts labelled with {} rollouts ({} saved)".format(np.sum(n_rollouts), n_saved))
+        if return_rew:
+            return labels, mean_rewards.reshape(-1, 1)
+        return labels
+
     result = evaluate_states(
         states, env, policy, horizon, as_goals=as_goals,
-        n_traj=n_traj, n_processes=n_processes, key=key, full_path=full_path
+        n_traj=n_traj, n_processes=n_processes, key=key, full_path=full_path, lockstep=lockstep, n_envs=n_envs,
+        cache=cache,
     )
     if full_path:
         mean_rewards, paths = result
@@ -185,6 +335,107 @@ def label_states(states, env, policy, horizon, as_goals=True, min_reward=0.1, ma
     return labels
 
 
+def _mean_reward_bounds(sums, counts, n_traj, reward_range, bound=None, confidence=0.95):
+    """
+    Interval of the mean reward of a state, given the sum of the rewards of its first counts rollouts. Without a bound,
+    this is the range of the mean over all the n_traj rollouts whatever the rewards of the remaining ones. With a
+    'hoeffding' or 'wilson' (for binary rewards) bound, it is intersected with a confidence interval on the expected
+    reward.
+    """
+    low_reward, high_reward = reward_range
+    remaining = n_traj - counts
+    low = (sums + remaining * low_reward) / n_traj
+    high = (sums + remaining * high_reward) / n_traj
+    if bound is None:
+        return low, high
+    means = sums / counts
+    delta = 1 - confidence
+    if bound == 'hoeffding':
+        eps = (high_reward - low_reward) * np.sqrt(np.log(2 / delta) / (2 * counts))
+        conf_low, conf_high = means - eps, means + eps
+    elif bound == 'wilson':
+        z = scipy.stats.norm.ppf(1 - delta / 2)
+        p = (means - low_reward) / (high_reward - low_reward)
+        denominator = 1 + z ** 2 / counts
+        center = (p + z ** 2 / (2 * counts)) / denominator
+        half_width = z * np.sqrt(p * (1 - p) / counts + z ** 2 / (4 * counts ** 2)) / denominator
+        conf_low = low_reward + (high_reward - low_reward) * (center - half_width)
+        conf_high = low_reward + (high_reward - low_reward) * (center + half_width)
+    else:
+        raise ValueError("Unknown bound: {}".format(bound))
+    return np.maximum(low, conf_low), np.minimum(high, conf_high)
+
+
+def _labels_settled(low, high, min_reward, max_reward, old_rewards=None, improvement_threshold=0.1):
+    """ Whether every label of compute_labels is the same for all the mean rewards between low and high. """
+    settled = ((low > min_reward) | (high <= min_reward)) & ((high < max_reward) | (low >= max_reward))
+    if old_rewards is not None:
+        settled &= (
+            (high <= old_rewards - improvement_threshold) | (low >= old_rewards + improvement_threshold) |
+            ((low > old_rewards - improvement_threshold) & (high < old_rewards + improvement_threshold))
+        )
+    return settled
+
+
+def evaluate_states_adaptive(states, env, policy, horizon, n_traj=1, min_reward=0.1, max_reward=0.9, old_rewards=None,
+                             improvement_threshold=0.1, key='goal_reached', as_goals=True, aggregator=None,
+                             n_processes=-1, bound=None, confidence=0.95, reward_range=None, round_traj=1,
+                             lockstep=False, n_envs=32):
+    """
+    Label the states like label_states, running up to n_traj rollouts per state in rounds of round_traj rollouts, and
+    stopping as soon as the label of a state is settled.
+    :param aggregator: (per path, over the rollouts) aggregators of the rewards, the second one must be np.mean;
+    defaults to np.max over a path for the 0/1 indicator goal_reached (whether the goal was reached at all, also for
+    envs that do not terminate at the goal), and to np.sum otherwise
+    :param bound: None to stop only when the remaining rollouts cannot change the label, whatever their rewards, so
+    that the labels are those of the mean over the rollouts run. This rarely settles a label before all the n_traj
+    rollouts are run (e.g. for min_reward=0.1, max_reward=0.9 and a few rollouts), so early stopping needs a
+    'hoeffding' bound, or a 'wilson' bound for binary rewards such as goal_reached, which also stop when a
+    confidence interval (at the given confidence) on the expected reward settles the label.
+    :param reward_range: bounds of the reward of a single rollout (aggregator[0] over a path). It can only be left
+    to None for goal_reached aggregated with np.max over a path, for which it is (0, 1); a ValueError is raised if the
+    rewards of the rollouts fall outside of it.
+    :return: labels, mean rewards over the rollouts run, number of rollouts run per state, and number of rollouts
+    saved compared to running n_traj for every state
+    """
+    if aggregator is None:
+        aggregator = (np.max if key == 'goal_reached' else np.sum, np.mean)
+    assert aggregator[1] is np.mean, "the adaptive evaluation only supports averaging the rewards of the rollouts"
+    if reward_range is None:
+        if key != 'goal_reached' or aggregator[0] is not np.max:
+            raise ValueError("reward_range is required by the adaptive evaluation of the key {} aggregated with "
+                             "{}".format(key, getattr(aggregator[0], '__name__', aggregator[0])))
+        reward_range = (0, 1)
+    low_reward, high_reward = reward_range
+    states = np.array(states)
+    n_states = len(states)
+    if old_rewards is not None:
+        old_rewards = np.asarray(old_rewards).reshape(-1)
+    sums = np.zeros(n_states)
+    counts = np.zeros(n_states, dtype=int)
+    active = np.arange(n_states)
+    while len(active) > 0:
+        # all the active states have been evaluated in every round, so they have the same count
+        n_round = min(round_traj, n_traj - counts[active[0]])
+        round_sums = evaluate_states(
+            states[active], env, policy, horizon, n_traj=n_round, n_processes=n_processes, key=key,
+            as_goals=as_goals, aggregator=(aggregator[0], np.sum), lockstep=lockstep, n_envs=n_envs,
+        )
+        # the bounds would settle labels too early if the rewards of the rollouts can leave reward_range
+        if np.any(round_sums < n_round * low_reward - 1e-8) or np.any(round_sums > n_round * high_reward + 1e-8):
+            raise ValueError("The rewards of the rollouts are outside of reward_range {}".format(reward_range))
+        sums[active] += round_sums
+        counts[active] += n_round
+        low, high = _mean_reward_bounds(sums[active], counts[active], n_traj, reward_range, bound, confidence)
+        settled = _labels_settled(low, high, min_reward, max_reward,
+                                  None if old_rewards is None else old_rewards[active], improvement_threshold)
+        active = active[~settled & (counts[active] < n_traj)]
+    mean_rewards = sums / np.maximum(counts, 1)
+    labels = compute_labels(mean_rewards.reshape(-1, 1), old_rewards=old_rewards, min_reward=min_reward,
+                            max_reward=max_reward, improvement_threshold=improvement_threshold)
+    return labels, mean_rewards, counts, n_states * n_traj - np.sum(counts)
+
+
 def compute_labels(mean_rewards, old_rewards=None, min_reward=0.1, max_reward=0.9, improvement_threshold=0.1):
     logger.log("Computing state labels")
     if old_rewards is not None:
@@ -239,31 +490,179 @@ def convert_label(labels):
     return new_labels, classes
 
 
+class EvaluationCache(object):
+    """
+    LRU cache of the mean rewards computed by evaluate_states, keyed on the state quantized to the given resolution,
+    a hash of the policy parameters and the evaluation settings (horizon, key, n_traj, as_goals, aggregator). The env
+    is not part of the key, so a cache should only be used with one env.
+    """
+
+    def __init__(self, max_size=100000, resolution=1e-6):
+        self.max_size = max_size
+        self.resolution = resolution
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def policy_hash(policy):
+        return hashlib.md5(np.ascontiguousarray(policy.get_param_values()).tobytes()).hexdigest()
+
+    def make_key(self, state, settings):
+        state = np.round(np.asarray(state, dtype=float) / self.resolution).astype(np.int64)
+        return (tuple(state.reshape(-1)),) + settings
+
+    def get(self, key):
+        value = self._entries.get(key, None)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    @property
+    def size(self):
+        return len(self._entries)
+
+    @property
+    def hit_rate(self):
+        return self.hits / max(self.hits + self.misses, 1)
+
+    def log_diagnostics(self, prefix='EvalCache'):
+        logger.record_tabular(prefix + 'Size', self.size)
+        logger.record_tabular(prefix + 'HitRate', self.hit_rate)
+
+
+def _evaluate_states_cached(states, env, policy, horizon, cache, n_traj, key, as_goals, aggregator, **kwargs):
+    settings = (EvaluationCache.policy_hash(policy), horizon, key, n_traj, as_goals, aggregator)
+    keys = [cache.make_key(state, settings) for state in states]
+    mean_rewards = [cache.get(k) for k in keys]
+    # the states missing from the cache, each evaluated once even if it appears several times in the batch
+    missing = OrderedDict()
+    for i, k in enumerate(keys):
+        if mean_rewards[i] is None:
+            missing.setdefault(k, i)
+    if len(missing) > 0:
+        new_rewards = evaluate_states(
+            [states[i] for i in missing.values()], env, policy, horizon, n_traj=n_traj, key=key, as_goals=as_goals,
+            aggregator=aggregator, **kwargs
+        )
+        evaluated = OrderedDict(zip(missing.keys(), new_rewards))
+        for k, mean_reward in evaluated.items():
+            cache.put(k, mean_reward)
+        mean_rewards = [evaluated[k] if mean_reward is None else mean_reward
+                        for k, mean_reward in zip(keys, mean_rewards)]
+    logger.log("Evaluation cache: {} of {} states evaluated, hit rate {:.3f}".format(
+        len(missing), len(keys), cache.hit_rate))
+    return np.array(mean_rewards)
+
+
 def evaluate_states(states, env, policy, horizon, n_traj=1, n_processes=-1, full_path=False, key='rewards',
                     as_goals=True,
-                    aggregator=(np.sum, np.mean)):
-    evaluate_state_wrapper = FunctionWrapper(
-        evaluate_state,
-        env=env,
-        policy=policy,
-        horizon=horizon,
-        n_traj=n_traj,
-        full_path=full_path,
-        key=key,
-        as_goals=as_goals,
-        aggregator=aggregator,
-    )
-    result = parallel_map(  # if full_path this is a list of tuples
-        evaluate_state_wrapper,
-        states,
-        n_processes,
-    )
+                    aggregator=(np.sum, np.mean), lockstep=False, n_envs=32, cache=None):
+    """
+    :param lockstep: on each worker, roll out all the (state, trajectory) pairs of its share of the states on up to
+    n_envs copies of the env stepped in lockstep, with one policy.get_actions call per step (see
+    evaluate_states_lockstep). Ignored for recurrent policies.
+    :param cache: optional EvaluationCache holding the mean rewards of the states already evaluated with the same
+    policy parameters and settings. Not used with full_path.
+    """
+    if cache is not None and not full_path:
+        return _evaluate_states_cached(
+            states, env, policy, horizon, cache, n_traj=n_traj, key=key, as_goals=as_goals, aggregator=aggregator,
+            n_processes=n_processes, lockstep=lockstep, n_envs=n_envs
+        )
+    if lockstep and not policy.recurrent:
+        from rllab.sampler.stateful_pool import singleton_pool
+        n_chunks = 1 if n_processes == 1 else singleton_pool.n_parallel
+        result = [
+            state_result
+            for chunk_result in persistent_map(
+                evaluate_states_lockstep,
+                _split(list(states), n_chunks),
+                env,
+                policy,
+                n_processes,
+                horizon=horizon,
+                n_traj=n_traj,
+                full_path=full_path,
+                key=key,
+                as_goals=as_goals,
+                aggregator=aggregator,
+                n_envs=n_envs,
+            )
+            for state_result in chunk_result
+        ]
+    else:
+        result = persistent_map(  # if full_path this is a list of tuples
+            evaluate_state,
+            states,
+            env,
+            policy,
+            n_processes,
+            horizon=horizon,
+            n_traj=n_traj,
+            full_path=full_path,
+            key=key,
+            as_goals=as_goals,
+            aggregator=aggregator,
+        )
 
     if full_path:
         return np.array([state[0] for state in result]), [path for state in result for path in state[1]]
     return np.array(result)
 
 
+# copies of the env used by evaluate_states_lockstep, kept as long as the env they were made from does not change
+_lockstep_envs = dict()
+
+
+def _get_lockstep_envs(env, n_envs):
+    from rllab.sampler.parallel_sampler import _env_fingerprint
+    fingerprint, _ = _env_fingerprint(env)
+    if _lockstep_envs.get('env') is not env or _lockstep_envs.get('fingerprint') != fingerprint:
+        for copy in _lockstep_envs.get('envs', [])[1:]:
+            copy.terminate()
+        _lockstep_envs.update(env=env, fingerprint=fingerprint, envs=[env])
+    envs = _lockstep_envs['envs']
+    while len(envs) < n_envs:
+        envs.append(cloudpickle.loads(cloudpickle.dumps(env)))
+    return envs[:n_envs]
+
+
+def evaluate_states_lockstep(states, env, policy, horizon, n_traj=1, full_path=False, key='rewards', as_goals=True,
+                             aggregator=(np.sum, np.mean), n_envs=32):
+    """
+    Same results as evaluate_state for each of the states, but with the rollouts of all the (state, trajectory) pairs
+    run on up to n_envs copies of env in lockstep (see vectorized_rollout).
+    :return: list with the result of evaluate_state for each state
+    """
+    if len(states) == 0:
+        return []
+    envs = _get_lockstep_envs(env, min(n_envs, len(states) * n_traj))
+
+    def set_state(slot_env, path_idx):
+        if as_goals:
+            slot_env.update_goal_generator(FixedStateGenerator(states[path_idx // n_traj]))
+        else:
+            slot_env.update_start_generator(FixedStateGenerator(states[path_idx // n_traj]))
+
+    paths = vectorized_rollout(envs, policy, horizon, n_paths=len(states) * n_traj, reset_hook=set_state)
+    results = []
+    for i in range(len(states)):
+        state_paths = paths[i * n_traj:(i + 1) * n_traj]
+        mean_reward = aggregator[1]([evaluate_path(path, key=key, aggregator=aggregator[0]) for path in state_paths])
+        results.append((mean_reward, state_paths) if full_path else mean_reward)
+    return results
+
+
 def evaluate_state(state, env, policy, horizon, n_traj=1, full_path=False, key='rewards', as_goals=True,
                    aggregator=(np.sum, np.mean)):
     aggregated_data = []
@@ -274,7 +673,7 @@ def evaluate_state(state, env, policy, horizon, n_traj=1, full_path=False, key='
         env.update_start_generator(FixedStateGenerator(state))
 
     for j in range(n_traj):
-        paths.append(rollout(env, policy, horizon))
+        paths.append(rollout(env, policy, horizon, preallocate=True))
 
         if key in paths[-1]:
             aggregated_data.append(
@@ -308,8 +707,11 @@ def evaluate_path(path, full_path=False, key='rewards', aggregator=np.sum):
     if not full_path:
         if key in path:
             total_reward = aggregator(path[key])
-        else:
+        elif key in path['env_infos']:
             total_reward = aggregator(path['env_infos'][key])
+        else:
+            # reduced on the worker, see RecordingSpec
+            total_reward = aggregator(path['summaries']['env_infos'][key])
         return total_reward
 
     if full_path:
@@ -1,10 +1,13 @@
 import multiprocessing
 from rllab.sampler.stateful_pool import singleton_pool
+from rllab.sampler.shared_memory import create_shm_file, remove_shm_file, _owned_files
 import scipy.spatial
 import random
 from rllab import spaces
 from rllab.misc import logger
 import sys
+import json
+import os
 import os.path as osp
 
 import matplotlib as mpl
@@ -18,95 +21,603 @@ import scipy.misc
 from curriculum.state.evaluator import parallel_map, disable_cuda_initializer
 
 
-class StateCollection(object):
-    """ A collection of states, with minimum distance threshold for new states. """
+class _SpatialIndex(object):
+    """
+    Incremental index of points for nearest neighbour distance queries: a forest of KD-trees whose sizes decrease
+    geometrically (logarithmic method). Adding points merges them with the smaller trees into a new tree, so every
+    point is rebuilt O(log n) times overall, and a query visits O(log n) trees. Removed points are only marked as
+    such, and dropped when their tree is merged or when they outnumber the remaining points.
+    """
+
+    def __init__(self):
+        # list of (tree, ids of its points)
+        self.trees = []
+        self.alive = np.zeros(0, dtype=bool)
+        self.n_ids = 0
+        self.size = 0
+
+    def add(self, points):
+        """ :return: the ids of the points, used to remove them """
+        points = np.asarray(points, dtype=np.float64)
+        ids = np.arange(self.n_ids, self.n_ids + len(points))
+        if len(points) == 0:
+            return ids
+        if self.n_ids + len(points) > len(self.alive):
+            alive = np.zeros(max(2 * len(self.alive), self.n_ids + len(points)), dtype=bool)
+            alive[:self.n_ids] = self.alive[:self.n_ids]
+            self.alive = alive
+        self.alive[ids] = True
+        self.n_ids += len(points)
+        self.size += len(points)
+        self._merge([points.reshape(len(points), -1)], [ids])
+        return ids
+
+    def _merge(self, blocks, block_ids):
+        n_points = len(blocks[0])
+        while len(self.trees) > 0 and self.trees[-1][0].n <= n_points:
+            tree, ids = self.trees.pop()
+            alive = self.alive[ids]
+            blocks.append(tree.data[alive])
+            block_ids.append(ids[alive])
+            n_points += tree.n
+        points = np.concatenate(blocks)
+        if len(points) > 0:
+            self.trees.append((scipy.spatial.cKDTree(points), np.concatenate(block_ids)))
+
+    def remove(self, ids):
+        self.alive[ids] = False
+        self.size -= len(ids)
+        n_points = sum(tree.n for tree, _ in self.trees)
+        if n_points > 2 * self.size:
+            # rebuild a single tree from the remaining points
+            trees, self.trees = self.trees, []
+            blocks = [tree.data[self.alive[tree_ids]] for tree, tree_ids in trees]
+            block_ids = [tree_ids[self.alive[tree_ids]] for tree, tree_ids in trees]
+            self._merge([np.concatenate(blocks)], [np.concatenate(block_ids)])
+
+    def min_distances(self, points, upper_bound=np.inf, n_process=None):
+        """ Distance from each point to its nearest neighbour in the index, or inf if it is beyond upper_bound. """
+        points = np.asarray(points, dtype=np.float64)
+        distances = np.full(len(points), np.inf)
+        for tree, ids in self.trees:
+            tree_distances, neighbors = tree.query(points, k=1, distance_upper_bound=upper_bound)
+            found = np.nonzero(np.isfinite(tree_distances))[0]
+            # the nearest neighbour was removed, look for the nearest remaining one within the bound
+            for i in found[~self.alive[ids[neighbors[found]]]]:
+                near = np.asarray(tree.query_ball_point(points[i], upper_bound), dtype=np.int64)
+                near = near[self.alive[ids[near]]]
+                tree_distances[i] = np.inf if len(near) == 0 else \
+                    np.min(np.linalg.norm(tree.data[near] - points[i], axis=1))
+            distances = np.minimum(distances, tree_distances)
+        return distances
+
+
+def blocked_min_distances(points, queries, memory_budget=2 ** 28, upper_bound=np.inf):
+    """
+    Distance from each query to its nearest point, computed with cdist on blocks of points and queries so that
+    the distance blocks take at most memory_budget bytes. Distances beyond upper_bound are returned as inf, like
+    with cKDTree.query.
+    """
+    queries = np.asarray(queries, dtype=np.float64)
+    distances = np.full(len(queries), np.inf)
+    if len(points) == 0 or len(queries) == 0:
+        return distances
+    block_elements = max(memory_budget // 8, 1)
+    query_block = int(min(len(queries), max(block_elements // len(points), 1024)))
+    point_block = int(max(block_elements // query_block, 1))
+    for q in range(0, len(queries), query_block):
+        block_distances = distances[q:q + query_block]
+        for p in range(0, len(points), point_block):
+            block = scipy.spatial.distance.cdist(np.asarray(points[p:p + point_block]), queries[q:q + query_block])
+            np.minimum(block_distances, block.min(axis=0), out=block_distances)
+    distances[distances > upper_bound] = np.inf
+    return distances
+
+
+def _worker_blocked_min_distances(G, index, queries, upper_bound):
+    return blocked_min_distances(index.points, queries, index.memory_budget, upper_bound)
+
+
+class _BlockedDistanceIndex(object):
+    """
+    Exact nearest neighbour distances computed block-wise with a memory budget, sharded over the worker pool. The
+    points are kept in a shared memory file that the workers map read-only, so that they are not sent to them: a
+    pickled index only holds the name of the file. Unlike KD-trees, this does not degrade with the dimension.
+    """
+
+    def __init__(self, memory_budget=2 ** 28):
+        self.memory_budget = memory_budget
+        self.filename = None
+        self.capacity = 0
+        self.row_size = None
+        self.size = 0
+
+    @property
+    def points(self):
+        if self.size == 0:
+            return np.empty((0, self.row_size or 0))
+        return np.memmap(self.filename, dtype=np.float64, mode='r', shape=(self.size, self.row_size))
+
+    def add(self, points):
+        points = np.asarray(points, dtype=np.float64)
+        ids = np.arange(self.size, self.size + len(points))
+        if len(points) == 0:
+            return ids
+        points = points.reshape(len(points), -1)
+        if self.size + len(points) > self.capacity:
+            # the file doubles in size like _GrowingArray, and the workers map the new file at the next query
+            capacity = max(2 * self.capacity, self.size + len(points), 1024)
+            filename = create_shm_file("rllab_states_", capacity * points.shape[1] * 8)
+            _owned_files.add(filename)
+            if self.size > 0:
+                np.memmap(filename, dtype=np.float64, mode='r+', shape=(self.size, self.row_size))[:] = self.points
+            self.close()
+            self.filename, self.capacity, self.row_size = filename, capacity, points.shape[1]
+        rows = np.memmap(self.filename, dtype=np.float64, mode='r+', shape=(self.capacity, self.row_size))
+        rows[self.size:self.size + len(points)] = points
+        rows.flush()
+        self.size += len(points)
+        return ids
+
+    def min_distances(self, points, upper_bound=np.inf, n_process=None):
+        """ :param n_process: number of shards of the points, by default one per worker; 1 for no sharding """
+        points = np.asarray(points, dtype=np.float64)
+        n_workers = singleton_pool.n_parallel if n_process is None else min(n_process, singleton_pool.n_parallel)
+        if n_workers <= 1 or not singleton_pool.supports_shared_memory or len(points) < n_workers:
+            return blocked_min_distances(self.points, points, self.memory_budget, upper_bound)
+        chunks = np.array_split(points, n_workers)
+        results = singleton_pool.run_map(_worker_blocked_min_distances,
+                                         [(self, chunk, upper_bound) for chunk in chunks])
+        return np.concatenate(results)
+
+    def close(self):
+        if self.filename is not None:
+            remove_shm_file(self.filename)
+            _owned_files.discard(self.filename)
+            self.filename = None
+
+
+def _greedy_filter(points, distance_threshold):
+    """
+    Mask of the points kept by going through them in order and keeping each point at more than distance_threshold
+    from all the points kept before it.
+    """
+    points = np.asarray(points, dtype=np.float64)
+    tree = scipy.spatial.cKDTree(points)
+    keep = np.zeros(len(points), dtype=bool)
+    rejected = np.zeros(len(points), dtype=bool)
+    for i in range(len(points)):
+        if rejected[i]:
+            continue
+        keep[i] = True
+        # the kept points are far from each other, so only few balls have to be queried
+        rejected[tree.query_ball_point(points[i], distance_threshold)] = True
+    return keep
+
+
+class _GrowingArray(object):
+    """
+    Rows stored in a contiguous float array whose capacity doubles when it is full, so that appending is amortized
+    O(1) per row and reading the rows is a view rather than a copy.
+    """
+
+    def __init__(self, rows=(), dtype=np.float64):
+        self.dtype = dtype
+        self._data = None
+        self._n = 0
+        self._view = None
+        self.extend(rows)
+
+    def __len__(self):
+        return self._n
+
+    def extend(self, rows):
+        rows = np.asarray(rows, dtype=self.dtype)
+        if len(rows) == 0:
+            return
+        rows = rows.reshape(len(rows), -1)
+        if self._data is None:
+            self._data = np.empty((max(len(rows), 16), rows.shape[1]), dtype=self.dtype)
+        elif self._n + len(rows) > len(self._data):
+            grown = np.empty((max(2 * len(self._data), self._n + len(rows)), self._data.shape[1]), dtype=self.dtype)
+            grown[:self._n] = self._data[:self._n]
+            self._data = grown
+        self._data[self._n:self._n + len(rows)] = rows
+        self._n += len(rows)
+        self._view = None
+
+    def remove(self, indices):
+        """ Remove rows in O(number of removed rows) by moving the last rows into their place. """
+        indices = np.unique(indices)
+        n = self._n - len(indices)
+        holes = indices[indices < n]
+        moved = np.setdiff1d(np.arange(n, self._n), indices, assume_unique=True)
+        if not self._data.flags.writeable:
+            # memory-mapped from a file
+            self._data = np.array(self._data[:self._n])
+        self._data[holes] = self._data[moved]
+        self._n = n
+        self._view = None
+
+    @property
+    def view(self):
+        """ Read-only view of the rows, cached until the next extend or remove. """
+        if self._view is None:
+            if self._data is None:
+                self._view = np.empty((0, 0), dtype=self.dtype)
+            else:
+                self._view = self._data[:self._n]
+            self._view.flags.writeable = False
+        return self._view
+
+    @classmethod
+    def load(cls, filename, n_rows, row_size, mmap=True):
+        """
+        Rows stored as raw float64 in a file. With mmap, the rows are a read-only memory map of the file, so that
+        only the rows that are accessed are read; the first extend copies them to memory.
+        """
+        array = cls()
+        if n_rows > 0:
+            if mmap:
+                array._data = np.memmap(filename, dtype=np.float64, mode='r', shape=(n_rows, row_size))
+            else:
+                array._data = np.fromfile(filename, dtype=np.float64, count=n_rows * row_size).reshape(n_rows, -1)
+            array._n = n_rows
+        return array
+
+    def __getstate__(self):
+        # only the rows are pickled, not the unused capacity
+        return dict(rows=np.array(self.view))
+
+    def __setstate__(self, d):
+        self.__init__(d["rows"], dtype=d["rows"].dtype)
+
+
+STATE_FILE_VERSION = 1
+
+
+def _write_rows(filename, rows, n_rows_in_file, row_size):
+    """
+    Write the rows after the first n_rows_in_file rows of a file of raw float64 rows of row_size entries, dropping
+    anything after them, e.g. the rows of a checkpoint that was interrupted before its header was written.
+    """
+    rows = np.ascontiguousarray(rows, dtype=np.float64)
+    with open(filename, 'r+b' if osp.exists(filename) else 'w+b') as f:
+        # also when there is no row to write, so that the rows already in the file are kept
+        f.seek(n_rows_in_file * row_size * rows.itemsize)
+        if len(rows) > 0:
+            f.write(rows.tobytes())
+        f.truncate()
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _rows_filenames(prefix, generation):
+    """
+    Files of the states and transformed states of a checkpoint. A checkpoint rewriting all the states writes them to
+    the files of a new generation, so that the files of the previous header are left untouched until it is replaced.
+    """
+    if generation == 0:
+        return prefix + '.states', prefix + '.transformed'
+    return '{}.{}.states'.format(prefix, generation), '{}.{}.transformed'.format(prefix, generation)
+
+
+def _read_header(filename):
+    with open(filename) as f:
+        return json.load(f)
+
+
+def _write_header(filename, header):
+    # written next to the header and renamed over it, so that the header is never left half written
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'w') as f:
+        json.dump(header, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_filename, filename)
+
+
+class EvictionPolicy(object):
+    """ Chooses the states that a StateCollection with a max_size evicts when it is full. """
+
+    def select(self, collection, n_evict):
+        """
+        :return: the indices in collection.state_list of the n_evict states to evict
+        """
+        raise NotImplementedError
+
+    def record_rewards(self, states, rewards):
+        """ Called with the latest mean rewards of states of the collection, for policies that use them. """
+        pass
+
+    def forget(self, states):
+        """ Called with the evicted states. """
+        pass
+
+
+class RandomEviction(EvictionPolicy):
+    """ Evict uniformly at random, so that the collection is a uniform sample of the states appended to it. """
+
+    def select(self, collection, n_evict):
+        return np.random.choice(collection.size, n_evict, replace=False)
+
+
+class DensestEviction(EvictionPolicy):
+    """
+    Evict the states of the densest neighbourhoods first, i.e. the states closest to their k-th nearest neighbour,
+    which preserves the coverage of the state space.
+    """
+
+    def __init__(self, k=5):
+        self.k = k
+
+    def select(self, collection, n_evict):
+        points = collection.index_points
+        k = min(self.k + 1, len(points))
+        distances, _ = scipy.spatial.cKDTree(points).query(points, k=k)
+        # the first neighbour is the state itself
+        kth_distances = distances[:, -1] if k > 1 else np.zeros(len(points))
+        return np.argpartition(kth_distances, n_evict - 1)[:n_evict] if n_evict > 0 else np.zeros(0, dtype=int)
+
+
+class CellReservoirEviction(EvictionPolicy):
+    """
+    Split the state space in a grid of cells of side cell_size, and evict at random from the most populated cells,
+    so that every cell keeps a reservoir of states of about the same size.
+    """
+
+    def __init__(self, cell_size):
+        self.cell_size = cell_size
+
+    def select(self, collection, n_evict):
+        cells = np.ascontiguousarray(np.floor(collection.index_points / self.cell_size).astype(np.int64))
+        cell_keys = cells.view(np.dtype((np.void, cells.dtype.itemsize * cells.shape[1]))).reshape(-1)
+        _, cell_idx, counts = np.unique(cell_keys, return_inverse=True, return_counts=True)
+        cell_idx = cell_idx.reshape(-1)
+        n_keep = collection.size - n_evict
+        # smallest capacity per cell such that the cells keep at least n_keep states
+        low, high = 0, counts.max()
+        while low < high:
+            mid = (low + high) // 2
+            if np.minimum(counts, mid).sum() >= n_keep:
+                high = mid
+            else:
+                low = mid + 1
+        capacity = low
+        # rank of each state within its cell, in random order
+        order = np.lexsort((np.random.rand(len(cell_idx)), cell_idx))
+        rank = np.empty(len(order), dtype=np.int64)
+        rank[order] = np.arange(len(order)) - (np.cumsum(counts) - counts)[cell_idx[order]]
+        evict = np.nonzero(rank >= capacity)[0]
+        # some of the cells at capacity give up one more state to evict exactly n_evict states
+        at_capacity = np.nonzero(rank == capacity - 1)[0]
+        return np.concatenate([evict, np.random.choice(at_capacity, n_evict - len(evict), replace=False)])
+
+
+class MasteredEviction(EvictionPolicy):
+    """
+    Evict the states already mastered first, i.e. whose last mean reward recorded with record_rewards is above
+    max_reward, highest reward first, then fall back to another policy.
+    """
+
+    def __init__(self, max_reward=0.9, fallback=None):
+        self.max_reward = max_reward
+        self.fallback = fallback if fallback is not None else RandomEviction()
+        self.rewards = dict()
+
+    def record_rewards(self, states, rewards):
+        for state, reward in zip(states, np.asarray(rewards).reshape(-1)):
+            self.rewards[tuple(state)] = reward
+
+    def forget(self, states):
+        for state in states:
+            self.rewards.pop(tuple(state), None)
+
+    def select(self, collection, n_evict):
+        rewards = np.array([self.rewards.get(tuple(state), -np.inf) for state in collection.state_list])
+        mastered = np.nonzero(rewards > self.max_reward)[0]
+        mastered = mastered[np.argsort(-rewards[mastered], kind='mergesort')][:n_evict]
+        if len(mastered) == n_evict:
+            return mastered
+        # at most len(mastered) of the n_evict states chosen by the fallback are already evicted
+        others = np.asarray(self.fallback.select(collection, n_evict), dtype=np.int64)
+        is_mastered = np.zeros(collection.size, dtype=bool)
+        is_mastered[mastered] = True
+        others = others[~is_mastered[others]]
+        return np.concatenate([mastered, others[:n_evict - len(mastered)]])
+
 
-    def __init__(self, distance_threshold=None, states_transform = None, idx_lim=None):
+class StateCollection(object):
+    """
+    A collection of states, with minimum distance threshold for new states. The distances are computed on the first
+    idx_lim entries of the states, or on the states mapped by states_transform, and the collection keeps a spatial
+    index of those so that appending only costs a nearest neighbour query per new state.
+    """
+
+    # fraction of max_size evicted at once when the collection is full, so that selecting the states to evict,
+    # which looks at the whole collection, is amortized over many insertions
+    EVICTION_FRACTION = 0.1
+
+    def __init__(self, distance_threshold=None, states_transform = None, idx_lim=None, spatial_index=True,
+                 memory_budget=2 ** 28, max_size=None, eviction_policy=None):
+        """
+        :param spatial_index: filter the new states against the collection with a KD-tree index. Otherwise, compute
+        the exact distances block-wise over the worker pool, which does better for high dimensional states
+        :param memory_budget: without the spatial index, the number of bytes of distances each process computes at
+        once
+        :param max_size: maximum number of states; when an append goes over it, states are evicted
+        :param eviction_policy: EvictionPolicy choosing the states to evict, RandomEviction by default
+        """
         self.distance_threshold = distance_threshold
         self.state_list = []
         self.states_transform = states_transform
         self.idx_lim = idx_lim
+        self.spatial_index = spatial_index
+        self.memory_budget = memory_budget
+        self.max_size = max_size
+        self.eviction_policy = eviction_policy if eviction_policy is not None else RandomEviction()
         if self.states_transform:
             self.transformed_state_list = []
+        self._index = None
+        self._index_ids = None
+
+    # the states (and their transforms) are stored in _GrowingArrays; state_list and transformed_state_list are
+    # read-only array views of them, and assigning a list to them replaces the content of the collection
+
+    @property
+    def state_list(self):
+        return self._states.view
+
+    @state_list.setter
+    def state_list(self, states):
+        self._states = _GrowingArray(states)
+        # the content was replaced, the next checkpoint rewrites all the states
+        self._checkpoint_prefix = None
+        self._n_checkpointed = 0
+
+    @property
+    def transformed_state_list(self):
+        return self._transformed_states.view
+
+    @transformed_state_list.setter
+    def transformed_state_list(self, transformed_states):
+        self._transformed_states = _GrowingArray(transformed_states)
+
+    @property
+    def index_points(self):
+        """ The states as the distances between them are computed: transformed, or their first idx_lim entries. """
+        if self.states_transform:
+            return self.transformed_state_list
+        return self.state_list[:, :self.idx_lim]
 
     @property
     def size(self):
-        return len(self.state_list)
+        return len(self._states)
 
     def empty(self):
         self.state_list = []
+        if self.states_transform:
+            self.transformed_state_list = []
+        if isinstance(self._index, _BlockedDistanceIndex):
+            self._index.close()
+        self._index = None
 
     def sample(self, size, replace=False, replay_noise=0):
-        states = sample_matrix_row(np.array(self.state_list), size, replace)
+        states = sample_matrix_row(self.state_list, size, replace)
+        if states is self.state_list:
+            # all the states are returned, copy them out of the collection
+            states = np.array(states)
         if replay_noise > 0:
             states += replay_noise * np.random.randn(*states.shape)
         return states
 
+    def _get_index(self):
+        # rebuilt if the state list was changed from outside of append, or the collection was unpickled
+        if self._index is None or self._index.size != len(self.state_list):
+            if isinstance(self._index, _BlockedDistanceIndex):
+                self._index.close()
+            if self.spatial_index:
+                self._index = _SpatialIndex()
+            else:
+                self._index = _BlockedDistanceIndex(self.memory_budget)
+            # ids of the states in the index, in the order of the state list
+            self._index_ids = _GrowingArray(dtype=np.int64)
+            if len(self.state_list) > 0:
+                self._index_ids.extend(self._index.add(self.index_points))
+        return self._index
+
+    def _add_to_index(self, points):
+        """ Must be called before the states are added to the state list. """
+        if self.distance_threshold is not None and self.distance_threshold > 0:
+            index = self._get_index()
+            self._index_ids.extend(index.add(points))
+
+    def _evict_if_full(self):
+        if self.max_size is None or self.size <= self.max_size:
+            return
+        n_evict = self.size - int(self.max_size * (1 - self.EVICTION_FRACTION))
+        indices = np.asarray(self.eviction_policy.select(self, n_evict), dtype=np.int64)
+        evicted = np.array(self.state_list[indices])
+        if isinstance(self._index, _SpatialIndex) and len(self._index_ids) == self.size:
+            self._index.remove(self._index_ids.view[indices, 0])
+            self._index_ids.remove(indices)
+        else:
+            # the blocked index is rebuilt at the next append
+            if isinstance(self._index, _BlockedDistanceIndex):
+                self._index.close()
+            self._index = None
+        self._states.remove(indices)
+        if self.states_transform:
+            self._transformed_states.remove(indices)
+        # the files of the checkpoints are append-only, the next one rewrites all the states
+        self._checkpoint_prefix = None
+        self._n_checkpointed = 0
+        self.eviction_policy.forget(evicted)
+        self._on_evict(indices, evicted)
+        logger.log("evicted {} states, {} left".format(len(evicted), self.size))
+
+    def _on_evict(self, indices, states):
+        """ Called after states were evicted, for subclasses keeping data about the states. """
+        pass
+
+    def record_rewards(self, states, rewards):
+        """ Pass the latest mean rewards of states of the collection to the eviction policy. """
+        self.eviction_policy.record_rewards(states, rewards)
+
+    def _far_from_collection(self, points, n_process=None):
+        """ Mask of the points at more than distance_threshold from all the states of the collection. """
+        return self._get_index().min_distances(points, upper_bound=2 * self.distance_threshold,
+                                               n_process=n_process) > self.distance_threshold
+
     def append(self, states, n_process=None):
+        """
+        :param n_process: number of workers filtering the states against the collection when it does not use the
+        spatial index (see _BlockedDistanceIndex); by default all of them, and 1, 0 or -1 for none
+        :return: the states added, some of which may have been evicted right away if the collection is full
+        """
+        added_states = self._insert(states, n_process)
+        self._evict_if_full()
+        return added_states
+
+    def _insert(self, states, n_process=None):
         if self.states_transform:
-            return self.append_states_transform(states)
+            return self._insert_states_transform(states)
         if len(states) > 0:
             states = np.array(states)
             logger.log("we are trying to append states: {}".format(states.shape))
             if self.distance_threshold is not None and self.distance_threshold > 0:
                 states = self._process_states(states)
             logger.log("after processing, we are left with : {}".format(states.shape))
-            if n_process is None:
-                n_process = singleton_pool.n_parallel
-            elif n_process in [-1, 0]:
-                n_process = 1
-            if states.shape[0] >= n_process > 1:
-                states_per_process = states.shape[0] // singleton_pool.n_parallel
-                list_of_states = [states[i * states_per_process: (i+1) * states_per_process, :] for i in range(n_process-1)]
-                list_of_states.append(states[states_per_process * (n_process - 1):, :])
-                states = parallel_map(self._select_states, list_of_states)
-                states = np.concatenate(states)
-            else:
-                states = self._select_states(states)
-            self.state_list.extend(states.tolist())
+            states = self._select_states(states, n_process)
+            self._add_to_index(states[:, :self.idx_lim])
+            self._states.extend(states)
             return states
 
-    def _select_states(self, states):
-        # print('selecting states from shape: ', states.shape)
+    def _select_states(self, states, n_process=None):
         selected_states = states
-        selected_states_idx_lim = np.array([state[:self.idx_lim] for state in states])
-        # print('selecting states from shape (after idx_lim of ', self.idx_lim, ': ', selected_states_idx_lim.shape)
-        state_list_idx_lim = np.array([state[:self.idx_lim] for state in self.state_list])
-        # print('the state_list_idx_lim shape: ', np.shape(self.state_list))
         if self.distance_threshold is not None and self.distance_threshold > 0:
             if len(self.state_list) > 0:
-                dists = scipy.spatial.distance.cdist(state_list_idx_lim, selected_states_idx_lim)
-                indices = np.amin(dists, axis=0) > self.distance_threshold
-                selected_states = selected_states[indices, :]
-        # print('the selected states are: {}'.format(selected_states.shape))
+                far = self._far_from_collection(states[:, :self.idx_lim], n_process)
+                selected_states = selected_states[far, :]
         return selected_states
 
     def _process_states(self, states):
         "keep only the states that are at more than dist_threshold from each other"
-        # adding a states transform allows you to maintain full state information while possibly disregarding some dim
         states = np.array(states)
-        results = [states[0]]
-        results_idx_lim = [states[0][:self.idx_lim]]
-        for i, state in enumerate(states[1:]):
-            # print("analyzing state : ", i)
-            if np.amin(scipy.spatial.distance.cdist(results_idx_lim, state.reshape(1, -1)[:self.idx_lim])) > self.distance_threshold:
-                results.append(state)
-                results_idx_lim.append(state[:self.idx_lim])
-        return np.array(results)
+        return states[_greedy_filter(states[:, :self.idx_lim], self.distance_threshold)]
 
     def _process_states_transform(self, states, transformed_states):
         "keep only the states that are at more than dist_threshold from each other"
         # adding a states transform allows you to maintain full state information while possibly disregarding some dim
-        results = [states[0]]
-        transformed_results = [transformed_states[0]]
-        for i in range(1, len(states)):
-            # checks if valid in transformed space
-            if np.amin(scipy.spatial.distance.cdist(transformed_results, transformed_states[i].reshape(1, -1))) > self.distance_threshold:
-                results.append(states[i])
-                transformed_results.append(transformed_states[i])
-        return np.array(results), np.array(transformed_results)
+        keep = _greedy_filter(transformed_states, self.distance_threshold)
+        return np.array(states)[keep], np.array(transformed_states)[keep]
 
     def append_states_transform(self, states):
+        added_states = self._insert_states_transform(states)
+        self._evict_if_full()
+        return added_states
+
+    def _insert_states_transform(self, states):
         assert self.idx_lim is None, "Can't use state transform and idx_lim with StateCollection!"
         if len(states) > 0:
             states = np.array(states)
@@ -114,16 +625,82 @@ class StateCollection(object):
             if self.distance_threshold is not None and self.distance_threshold > 0:
                 states, transformed_states = self._process_states_transform(states, transformed_states)
                 if len(self.state_list) > 0:
-                    print("hi")
-                    dists = scipy.spatial.distance.cdist(self.transformed_state_list, transformed_states)
-                    indices = np.amin(dists, axis=0) > self.distance_threshold
+                    indices = self._far_from_collection(transformed_states)
                     states = states[indices, :]
                     transformed_states = transformed_states[indices, :]
-            self.state_list.extend(states)
-            self.transformed_state_list.extend(transformed_states)
+            self._add_to_index(transformed_states)
+            self._states.extend(states)
+            self._transformed_states.extend(transformed_states)
             assert(len(self.state_list) == len(self.transformed_state_list))
         return states # modifed to return added states
 
+    def checkpoint(self, prefix):
+        """
+        Save the collection to prefix.json (header) and prefix.states and prefix.transformed (raw float64 rows, see
+        load_state_collection). Only the states added since the last checkpoint to the same prefix are appended to
+        the files. When all the states have to be written again (e.g. after an eviction), they are written to new
+        files, and the files of the previous checkpoint are only removed once the header points to the new ones. The
+        rows are written before the header, which is replaced atomically, so an interrupted checkpoint leaves the
+        previous one readable.
+        """
+        n_states = self.size
+        if prefix == self._checkpoint_prefix:
+            generation = self._checkpoint_generation
+            n_checkpointed = self._n_checkpointed
+            old_generation = None
+        else:
+            old_generation = _read_header(prefix + '.json').get('generation', 0) \
+                if osp.exists(prefix + '.json') else None
+            generation = 0 if old_generation is None else old_generation + 1
+            n_checkpointed = 0
+        state_dim = int(self.state_list.shape[1]) if n_states > 0 else None
+        transformed_dim = int(self.transformed_state_list.shape[1]) if self.states_transform and n_states > 0 else None
+        states_filename, transformed_filename = _rows_filenames(prefix, generation)
+        _write_rows(states_filename, self.state_list[n_checkpointed:], n_checkpointed, state_dim or 0)
+        if self.states_transform:
+            _write_rows(transformed_filename, self.transformed_state_list[n_checkpointed:], n_checkpointed,
+                        transformed_dim or 0)
+        _write_header(prefix + '.json', dict(
+            version=STATE_FILE_VERSION,
+            generation=generation,
+            n_states=n_states,
+            state_dim=state_dim,
+            transformed_dim=transformed_dim,
+            distance_threshold=self.distance_threshold,
+            idx_lim=self.idx_lim,
+        ))
+        if old_generation is not None:
+            for filename in _rows_filenames(prefix, old_generation):
+                if osp.exists(filename):
+                    os.remove(filename)
+        self._checkpoint_prefix = prefix
+        self._checkpoint_generation = generation
+        self._n_checkpointed = n_states
+
+    def __getstate__(self):
+        d = self.__dict__.copy()
+        # rebuilt on the first append after unpickling
+        d["_index"] = None
+        d["_index_ids"] = None
+        return d
+
+    def __setstate__(self, d):
+        d = dict(d)
+        # collections pickled before the array storage hold the states in lists
+        for key, attr in [("state_list", "_states"), ("transformed_state_list", "_transformed_states")]:
+            if key in d:
+                d[attr] = _GrowingArray(d.pop(key))
+        self.__dict__.update(d)
+        self.__dict__.setdefault("_index", None)
+        self.__dict__.setdefault("_index_ids", None)
+        self.__dict__.setdefault("max_size", None)
+        self.__dict__.setdefault("eviction_policy", RandomEviction())
+        self.__dict__.setdefault("spatial_index", True)
+        self.__dict__.setdefault("memory_budget", 2 ** 28)
+        self.__dict__.setdefault("_checkpoint_prefix", None)
+        self.__dict__.setdefault("_n_checkpointed", 0)
+        self.__dict__.setdefault("_checkpoint_generation", 0)
+
     # def append(self, states):
     #     if self.states_transform:
     #         return self.append_states_transform(states)
@@ -140,66 +717,150 @@ class StateCollection(object):
 
     @property
     def states(self):
-        return np.array(self.state_list)
+        return self.state_list
+
+def load_state_collection(prefix, states_transform=None, mmap=True):
+    """
+    Load a collection saved with StateCollection.checkpoint. With mmap, the states are memory-mapped, so sampling
+    from the collection only reads the sampled states from the file. Later checkpoints of the collection to the same
+    prefix append to the files.
+    :param states_transform: the transform of the saved collection, which cannot be saved with it; the transformed
+    states are read from the files if they were saved, otherwise computed
+    """
+    header = _read_header(prefix + '.json')
+    assert header['version'] == STATE_FILE_VERSION, "Unknown state collection version {}".format(header['version'])
+    n_states = header['n_states']
+    generation = header.get('generation', 0)
+    states_filename, transformed_filename = _rows_filenames(prefix, generation)
+    collection = StateCollection(distance_threshold=header['distance_threshold'], states_transform=states_transform,
+                                 idx_lim=header['idx_lim'])
+    collection._states = _GrowingArray.load(states_filename, n_states, header['state_dim'], mmap=mmap)
+    if states_transform:
+        if header['transformed_dim'] is not None:
+            collection._transformed_states = _GrowingArray.load(
+                transformed_filename, n_states, header['transformed_dim'], mmap=mmap)
+        elif n_states > 0:
+            collection._transformed_states = _GrowingArray(states_transform(collection.state_list))
+    if not states_transform or header['transformed_dim'] is not None:
+        # the files hold everything the collection would write, the next checkpoint can append to them
+        collection._checkpoint_prefix = prefix
+        collection._checkpoint_generation = generation
+        collection._n_checkpointed = n_states
+    return collection
+
 
 class SmartStateCollection(StateCollection):
+    """
+    StateCollection keeping a Q value per state (the smoothed improvement of its reward), and sampling a fraction
+    eps of the states uniformly and the rest among the states with the highest Q values. The Q values and previous
+    rewards are stored in arrays aligned with the state list, and a hash index from the states quantized to
+    resolution to their position in the state list replaces the linear searches of the states.
+    """
     # should be used same as before, just need to update Q values
     #TODO: update alpha smartly
-    def __init__(self, eps = 0.5, alpha = 0.3, abs = True, *args, **kwargs):
+    def __init__(self, eps = 0.5, alpha = 0.3, abs = True, resolution=1e-6, *args, **kwargs):
         self.eps = eps # percentage of random
         self.alpha = alpha
         self.abs = abs
-        self.q_vals = {} #TODO: smarter way to keep list sorted, maybe priority queue?
-        # use heapq https://stackoverflow.com/questions/7197315/5-maximum-values-in-a-python-dictionary if slow
-        self.prev_vals = {}
+        self.resolution = resolution
         super(SmartStateCollection, self).__init__(*args, **kwargs)
+        self._reset_values()
+
+    def _reset_values(self):
+        self._q = _GrowingArray()
+        self._prev = _GrowingArray()
+        self._slots = dict()
+
+    def _keys(self, states):
+        states = np.asarray(states, dtype=np.float64).reshape(len(states), -1)
+        quantized = np.ascontiguousarray(np.round(states / self.resolution).astype(np.int64))
+        return [row.tobytes() for row in quantized]
+
+    def _rebuild_slots(self):
+        self._slots = {key: slot for slot, key in enumerate(self._keys(self.state_list))}
+
+    def slots(self, states):
+        """ Position of each state in the state list, or -1 for the states not in the collection. """
+        if len(states) == 0:
+            return np.zeros(0, dtype=np.int64)
+        return np.array([self._slots.get(key, -1) for key in self._keys(states)], dtype=np.int64)
+
+    @property
+    def q_vals(self):
+        return {tuple(state): q for state, q in zip(self.state_list, self._q.view.reshape(-1))}
+
+    @property
+    def prev_vals(self):
+        return {tuple(state): prev for state, prev in zip(self.state_list, self._prev.view.reshape(-1))}
+
+    def empty(self):
+        super(SmartStateCollection, self).empty()
+        self._reset_values()
 
     def update_starts(self, states, rewards, only_good = True, logger = None):
-        old_states, old_rewards, new_states, new_rewards = [], [], [], []
-        for i in range(len(states)):
-            state = states[i]
-            reward = rewards[i]
-            if only_good:
-                # TODO: set option
-                # intuition is that we don't want states that we already master
-                if reward < 0.02 or reward > 0.98:
-                    continue
-            # check if state shows up
-            if len(self.state_list) > 0 and np.sum(np.all(state == self.state_list, axis = 1)) > 0:
-                old_states.append(state)
-                old_rewards.append(reward)
-            else:
-                new_states.append(state)
-                new_rewards.append(reward)
+        states = np.asarray(states)
+        rewards = np.asarray(rewards).reshape(-1)
+        # check if states show up
+        in_collection = self.slots(states) >= 0
+        self.record_rewards(states[in_collection], rewards[in_collection])
+        if only_good:
+            # TODO: set option
+            # intuition is that we don't want states that we already master
+            good = (rewards >= 0.02) & (rewards <= 0.98)
+        else:
+            good = np.ones(len(states), dtype=bool)
+        new = good & ~in_collection
         if logger is not None:
-            logger.log("Total states: {}  New states: {}".format(len(states), len(new_states)))
-        self.append(new_states, new_rewards)
-        self.update_q(old_states, old_rewards)
+            logger.log("Total states: {}  New states: {}".format(len(states), np.sum(new)))
+        # the old states are updated first since appending may evict some of them
+        self.update_q(states[good & in_collection], rewards[good & in_collection])
+        self.append(states[new], rewards[new])
 
     def append(self, states, rewards):
-        zero_index = 0 # check on np.argmax
-        added_states = super(SmartStateCollection, self).append(states)
-        for state in added_states:
-            index = np.argmax(np.all(states == state, axis =1)) # should only get one index
-            if index == 0:
-                zero_index += 1
-            reward = rewards[index]
-            self.q_vals[tuple(state)] = self.alpha * reward # TODO: not sure what the initialization should be, is there alpha term?
-            self.prev_vals[tuple(state)] = reward
-        assert (zero_index < 2)
+        if len(states) == 0:
+            return
+        n_states = self.size
+        added_states = self._insert(states)
+        if added_states is None or len(added_states) == 0:
+            return
+        # reward of the first occurrence of each added state among the appended ones
+        first_index = dict()
+        for i, key in enumerate(self._keys(states)):
+            first_index.setdefault(key, i)
+        added_keys = self._keys(added_states)
+        added_rewards = np.asarray(rewards, dtype=np.float64).reshape(-1)[[first_index[key] for key in added_keys]]
+        self._q.extend(self.alpha * added_rewards) # TODO: not sure what the initialization should be, is there alpha term?
+        self._prev.extend(added_rewards)
+        for slot, key in enumerate(added_keys, n_states):
+            self._slots[key] = slot
+        # after the Q values of the new states are set, so that they are dropped if the states are evicted
+        self._evict_if_full()
+
+    def _on_evict(self, indices, states):
+        # removed like the states, by moving the last values in their place
+        self._q.remove(indices)
+        self._prev.remove(indices)
+        self._rebuild_slots()
 
     def sample(self, size, replace=False, replay_noise=0):
         size_random_samples = int(size * self.eps)
         size_good_samples = size - size_random_samples
         print("Random starts: {}".format(size_random_samples))
-        states = sample_matrix_row(np.array(self.state_list), size_random_samples, replace)
+        states = sample_matrix_row(self.state_list, size_random_samples, replace)
+        if states is self.state_list:
+            # all the states are returned, copy them out of the collection
+            states = np.array(states)
         if size_good_samples == 0:
             return states # fully uniform states
-        if self.abs:
-            good_states = sorted(self.q_vals, key= lambda k: abs(self.q_vals[k]), reverse=True)[:size_good_samples]
+        q_vals = self._q.view.reshape(-1)
+        scores = np.abs(q_vals) if self.abs else q_vals
+        if size_good_samples < len(scores):
+            top = np.argpartition(-scores, size_good_samples - 1)[:size_good_samples]
         else:
-            good_states = sorted(self.q_vals, key=self.q_vals.get, reverse=True)[:size_good_samples]
-        good_states = np.array(good_states)
+            top = np.arange(len(scores))
+        # highest first, like sorting all the Q values
+        top = top[np.argsort(-scores[top], kind='mergesort')]
+        good_states = self.state_list[top]
         return np.concatenate((states, good_states))
         # if replay_noise > 0:
         #     states += replay_noise * np.random.randn(*states.shape)
@@ -207,15 +868,37 @@ class SmartStateCollection(StateCollection):
 
     def update_q(self, states, rewards):
         # updated should be true if there are enough samples
-        previous_values = np.array([self.prev_vals[tuple(state)] for state in states])
-        curr_q_values =  np.array([self.q_vals[tuple(state)] for state in states])
+        slots = self.slots(states)
+        if np.any(slots < 0):
+            raise KeyError("Q values can only be updated for states of the collection")
+        rewards = np.asarray(rewards, dtype=np.float64).reshape(-1)
+        previous_values = self._prev.view.reshape(-1)[slots]
+        curr_q_values = self._q.view.reshape(-1)[slots]
         improvement = rewards - previous_values
         new_values = self.alpha * improvement + (1 - self.alpha) * curr_q_values
-
-        for i in range(len(states)):
-            # if updated[i]:
-            self.q_vals[tuple(states[i])] = new_values[i]
-            self.prev_vals[tuple(states[i])] = rewards[i]
+        if len(slots) == 0:
+            return
+        # written in place, the views are read-only
+        self._q._data[slots, 0] = new_values
+        self._prev._data[slots, 0] = rewards
+
+    def __getstate__(self):
+        d = super(SmartStateCollection, self).__getstate__()
+        # rebuilt when unpickling
+        del d["_slots"]
+        return d
+
+    def __setstate__(self, d):
+        d = dict(d)
+        # collections pickled before the arrays hold the values in dicts keyed by the states
+        q_vals = d.pop("q_vals", None)
+        prev_vals = d.pop("prev_vals", None)
+        super(SmartStateCollection, self).__setstate__(d)
+        self.__dict__.setdefault("resolution", 1e-6)
+        if q_vals is not None:
+            self._q = _GrowingArray([q_vals[tuple(state)] for state in self.state_list])
+            self._prev = _GrowingArray([prev_vals[tuple(state)] for state in self.state_list])
+        self._rebuild_slots()
 
 
 
@@ -1,37 +1,74 @@
 from rllab.algos.base import RLAlgorithm
 from rllab.sampler import parallel_sampler
 from rllab.sampler.base import BaseSampler
+from rllab.sampler.path_batch import PathBatch
 import rllab.misc.logger as logger
 import rllab.plotter as plotter
+import numpy as np
 from rllab.policies.base import Policy
 
 
 class BatchSampler(BaseSampler):
-    def __init__(self, algo):
+    def __init__(self, algo, shared_transport=False, persistent_workers=False, instrument=False, recording=None):
         """
         :type algo: BatchPolopt
+        :param shared_transport: send the paths from the workers back to the master through shared memory instead
+        of pickling them
+        :param persistent_workers: keep the env and policy on the workers when shutting down, so that the next
+        algorithm using the same scope only sends what changed (see parallel_sampler.populate_task)
+        :param instrument: time the env steps, policy inference, resets and path serialization on the workers, and
+        record the totals in the Sampler/ tabular keys
+        :param recording: optional RecordingSpec selecting the env_info and agent_info entries kept in the paths,
+        e.g. to only keep the goal of goal envs at the first step (see rllab.sampler.utils.RecordingSpec)
         """
         self.algo = algo
+        self.shared_transport = shared_transport
+        self.persistent_workers = persistent_workers
+        self.instrument = instrument
+        self.recording = recording
 
     def start_worker(self):
         parallel_sampler.populate_task(self.algo.env, self.algo.policy, scope=self.algo.scope)
 
     def shutdown_worker(self):
-        parallel_sampler.terminate_task(scope=self.algo.scope)
+        parallel_sampler.terminate_task(scope=self.algo.scope, persistent=self.persistent_workers)
 
     def obtain_samples(self, itr):
+        return self.obtain_samples_async(itr).get()
+
+    def obtain_samples_async(self, itr):
         cur_params = self.algo.policy.get_param_values()
-        paths = parallel_sampler.sample_paths(
+        handle = parallel_sampler.sample_paths_async(
             policy_params=cur_params,
             max_samples=self.algo.batch_size,
             max_path_length=self.algo.max_path_length,
             scope=self.algo.scope,
+            shared_transport=self.shared_transport,
+            timed=self.instrument,
+            recording=self.recording,
         )
+        if self.instrument:
+            handle = handle.then(self._record_timings)
+        handle = handle.then(PathBatch.from_paths)
         if self.algo.whole_paths:
-            return paths
+            return handle
         else:
-            paths_truncated = parallel_sampler.truncate_paths(paths, self.algo.batch_size)
-            return paths_truncated
+            return handle.then(lambda paths: parallel_sampler.truncate_paths(paths, self.algo.batch_size))
+
+    def _record_timings(self, results):
+        paths, worker_stats = results
+        stats = list(worker_stats.values())
+        logger.record_tabular('Sampler/EnvStepTime', sum(s["env_step"] for s in stats))
+        logger.record_tabular('Sampler/PolicyTime', sum(s["policy"] for s in stats))
+        logger.record_tabular('Sampler/ResetTime', sum(s["reset"] for s in stats))
+        logger.record_tabular('Sampler/SerializationTime', sum(s["serialization"] for s in stats))
+        # time spent collecting by the busiest worker, compared to the average over the workers
+        worker_times = [s["total"] for s in stats]
+        logger.record_tabular('Sampler/StragglerMax', max(worker_times))
+        logger.record_tabular('Sampler/WorkerTimeMean', np.mean(worker_times))
+        logger.record_tabular('Sampler/WorkerPathsMin', min(s["n_paths"] for s in stats))
+        logger.record_tabular('Sampler/WorkerPathsMax', max(s["n_paths"] for s in stats))
+        return paths
 
 
 class BatchPolopt(RLAlgorithm):
@@ -60,6 +97,8 @@ class BatchPolopt(RLAlgorithm):
             whole_paths=True,
             sampler_cls=None,
             sampler_args=None,
+            pipelined=False,
+            path_summarizer=None,
             **kwargs
     ):
         """
@@ -81,6 +120,16 @@ class BatchPolopt(RLAlgorithm):
         :param positive_adv: Whether to shift the advantages so that they are always positive. When used in
         conjunction with center_adv the advantages will be standardized before shifting.
         :param store_paths: Whether to save all paths data to the snapshot.
+        :param sampler_cls: Sampler class used to collect the paths, BatchSampler by default. Use
+        rllab.sampler.vectorized_sampler.VectorizedSampler to batch the policy inference across env copies.
+        :param sampler_args: Extra keyword arguments to construct the sampler.
+        :param pipelined: Whether the workers collect the samples of the next iteration with the current policy
+        parameters while the policy is being optimized. The samples used at each iteration are then at most one
+        policy update stale, which is reported as SampleStaleness. Requires a sampler implementing
+        obtain_samples_async.
+        :param path_summarizer: Optional callable(itr, paths) called with the paths of each iteration instead of
+        keeping them until the end of train, which then returns the summarizer instead of the list of paths (see
+        curriculum.state.evaluator.StateRewardAccumulator).
         """
         self.env = env
         self.policy = policy
@@ -98,6 +147,10 @@ class BatchPolopt(RLAlgorithm):
         self.positive_adv = positive_adv
         self.store_paths = store_paths
         self.whole_paths = whole_paths
+        self.pipelined = pipelined
+        self.path_summarizer = path_summarizer
+        # number of policy updates so far, used to measure the staleness of pipelined samples
+        self.policy_version = 0
         if sampler_cls is None:
             sampler_cls = BatchSampler
         if sampler_args is None:
@@ -118,19 +171,38 @@ class BatchPolopt(RLAlgorithm):
         if not already_init:
             self.init_opt()
         all_paths = []
+        pending = None
         for itr in range(self.current_itr, self.n_itr):
             with logger.prefix('itr #%d | ' % itr):
-                paths = self.sampler.obtain_samples(itr)
+                if self.pipelined:
+                    if pending is None:
+                        pending = self._obtain_samples_async(itr)
+                    paths = pending.get()
+                    if pending.deferred:
+                        staleness = 0
+                    else:
+                        staleness = self.policy_version - pending.policy_version
+                    logger.record_tabular('SampleStaleness', staleness)
+                    pending = None
+                else:
+                    paths = self.sampler.obtain_samples(itr)
                 samples_data = self.sampler.process_samples(itr, paths)
                 self.log_diagnostics(paths)
+                if self.pipelined and itr + 1 < self.n_itr:
+                    # the workers collect the next batch with the current parameters while we optimize
+                    pending = self._obtain_samples_async(itr + 1)
                 self.optimize_policy(itr, samples_data)
+                self.policy_version += 1
                 logger.log("saving snapshot...")
                 params = self.get_itr_snapshot(itr, samples_data)
                 self.current_itr = itr + 1
                 params["algo"] = self
                 if self.store_paths:
                     params["paths"] = samples_data["paths"]
-                all_paths.append(paths)
+                if self.path_summarizer is not None:
+                    self.path_summarizer(itr, paths)
+                else:
+                    all_paths.append(paths)
                 logger.save_itr_params(itr, params)
                 logger.log("saved")
                 logger.dump_tabular(with_prefix=False)
@@ -141,8 +213,15 @@ class BatchPolopt(RLAlgorithm):
                                   "continue...")
 
         self.shutdown_worker()
+        if self.path_summarizer is not None:
+            return self.path_summarizer
         return all_paths
 
+    def _obtain_samples_async(self, itr):
+        handle = self.sampler.obtain_samples_async(itr)
+        handle.policy_version = self.policy_version
+        return handle
+
     def log_diagnostics(self, paths):
         self.env.log_diagnostics(paths)
         self.policy.log_diagnostics(paths)
@@ -1,5 +1,6 @@
 from rllab.baselines.base import Baseline
 from rllab.misc.overrides import overrides
+from rllab.sampler.path_batch import PathBatch
 import numpy as np
 
 
@@ -22,10 +23,22 @@ class LinearFeatureBaseline(Baseline):
         al = np.arange(l).reshape(-1, 1) / 100.0
         return np.concatenate([o, o ** 2, al, al ** 2, al ** 3, np.ones((l, 1))], axis=1)
 
+    def _batch_features(self, paths):
+        """ Features of all the steps of a PathBatch, computed on its columns at once. """
+        o = np.clip(paths.columns["observations"], -10, 10)
+        n = paths.n_samples
+        # time step of each sample within its path
+        al = (np.arange(n) - np.repeat(paths.offsets[:-1], paths.path_lengths)).reshape(-1, 1) / 100.0
+        return np.concatenate([o, o ** 2, al, al ** 2, al ** 3, np.ones((n, 1))], axis=1)
+
     @overrides
     def fit(self, paths):
-        featmat = np.concatenate([self._features(path) for path in paths])
-        returns = np.concatenate([path["returns"] for path in paths])
+        if isinstance(paths, PathBatch):
+            featmat = self._batch_features(paths)
+            returns = paths.columns["returns"]
+        else:
+            featmat = np.concatenate([self._features(path) for path in paths])
+            returns = np.concatenate([path["returns"] for path in paths])
         reg_coeff = self._reg_coeff
         for _ in range(5):
             self._coeffs = np.linalg.lstsq(
@@ -41,3 +54,12 @@ class LinearFeatureBaseline(Baseline):
         if self._coeffs is None:
             return np.zeros(len(path["rewards"]))
         return self._features(path).dot(self._coeffs)
+
+    def predict_n(self, paths):
+        if not isinstance(paths, PathBatch):
+            return [self.predict(path) for path in paths]
+        if self._coeffs is None:
+            values = np.zeros(paths.n_samples)
+        else:
+            values = self._batch_features(paths).dot(self._coeffs)
+        return np.split(values, paths.offsets[1:-1])
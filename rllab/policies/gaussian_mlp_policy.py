@@ -15,6 +15,7 @@ from rllab.policies.base import StochasticPolicy
 from rllab.misc.overrides import overrides
 from rllab.misc import logger
 from rllab.misc import ext
+from rllab.sampler.path_batch import PathBatch
 from rllab.distributions.diagonal_gaussian import DiagonalGaussian
 import theano.tensor as TT
 
@@ -172,7 +173,10 @@ class GaussianMLPPolicy(StochasticPolicy, LasagnePowered, Serializable):
         return new_action_var
 
     def log_diagnostics(self, paths):
-        log_stds = np.vstack([path["agent_infos"]["log_std"] for path in paths])
+        if isinstance(paths, PathBatch):
+            log_stds = paths.columns["agent_infos"]["log_std"]
+        else:
+            log_stds = np.vstack([path["agent_infos"]["log_std"] for path in paths])
         logger.record_tabular('AveragePolicyStd', np.mean(np.exp(log_stds)))
 
     @property
@@ -4,6 +4,7 @@ import numpy as np
 from rllab.misc import special
 from rllab.misc import tensor_utils
 from rllab.algos import util
+from rllab.sampler.path_batch import PathBatch
 import rllab.misc.logger as logger
 
 
@@ -26,7 +27,7 @@ class Sampler(object):
         """
         Return processed sample data (typically a dictionary of concatenated tensors) based on the collected paths.
         :param itr: Iteration number.
-        :param paths: A list of collected paths.
+        :param paths: A list of collected paths, or a PathBatch.
         :return: Processed sample data.
         """
         raise NotImplementedError
@@ -54,16 +55,33 @@ class BaseSampler(Sampler):
         else:
             all_path_baselines = [self.algo.baseline.predict(path) for path in paths]
 
+        is_batch = isinstance(paths, PathBatch)
+        if is_batch:
+            # written into columns of the batch instead of per-path arrays
+            all_advantages = np.empty(paths.n_samples)
+            all_returns = np.empty(paths.n_samples)
+
         for idx, path in enumerate(paths):
             path_baselines = np.append(all_path_baselines[idx], 0)
             deltas = path["rewards"] + \
                      self.algo.discount * path_baselines[1:] - \
                      path_baselines[:-1]
-            path["advantages"] = special.discount_cumsum(
+            path_advantages = special.discount_cumsum(
                 deltas, self.algo.discount * self.algo.gae_lambda)
-            path["returns"] = special.discount_cumsum(path["rewards"], self.algo.discount)
+            path_returns = special.discount_cumsum(path["rewards"], self.algo.discount)
+            if is_batch:
+                start, end = paths.offsets[idx], paths.offsets[idx + 1]
+                all_advantages[start:end] = path_advantages
+                all_returns[start:end] = path_returns
+            else:
+                path["advantages"] = path_advantages
+                path["returns"] = path_returns
             baselines.append(path_baselines[:-1])
-            returns.append(path["returns"])
+            returns.append(path_returns)
+
+        if is_batch:
+            paths.add_column("advantages", all_advantages)
+            paths.add_column("returns", all_returns)
 
         ev = special.explained_variance_1d(
             np.concatenate(baselines),
@@ -71,13 +89,22 @@ class BaseSampler(Sampler):
         )
 
         if not self.algo.policy.recurrent:
-            observations = tensor_utils.concat_tensor_list([path["observations"] for path in paths])
-            actions = tensor_utils.concat_tensor_list([path["actions"] for path in paths])
-            rewards = tensor_utils.concat_tensor_list([path["rewards"] for path in paths])
-            returns = tensor_utils.concat_tensor_list([path["returns"] for path in paths])
-            advantages = tensor_utils.concat_tensor_list([path["advantages"] for path in paths])
-            env_infos = tensor_utils.concat_tensor_dict_list([path["env_infos"] for path in paths])
-            agent_infos = tensor_utils.concat_tensor_dict_list([path["agent_infos"] for path in paths])
+            if is_batch:
+                observations = paths.columns["observations"]
+                actions = paths.columns["actions"]
+                rewards = paths.columns["rewards"]
+                returns = paths.columns["returns"]
+                advantages = paths.columns["advantages"]
+                env_infos = paths.columns.get("env_infos", dict())
+                agent_infos = paths.columns.get("agent_infos", dict())
+            else:
+                observations = tensor_utils.concat_tensor_list([path["observations"] for path in paths])
+                actions = tensor_utils.concat_tensor_list([path["actions"] for path in paths])
+                rewards = tensor_utils.concat_tensor_list([path["rewards"] for path in paths])
+                returns = tensor_utils.concat_tensor_list([path["returns"] for path in paths])
+                advantages = tensor_utils.concat_tensor_list([path["advantages"] for path in paths])
+                env_infos = tensor_utils.concat_tensor_dict_list([path["env_infos"] for path in paths])
+                agent_infos = tensor_utils.concat_tensor_dict_list([path["agent_infos"] for path in paths])
 
             if self.algo.center_adv:
                 advantages = util.center_advantages(advantages)
@@ -85,10 +112,13 @@ class BaseSampler(Sampler):
             if self.algo.positive_adv:
                 advantages = util.shift_advantages_to_positive(advantages)
 
-            average_discounted_return = \
-                np.mean([path["returns"][0] for path in paths])
-
-            undiscounted_returns = [sum(path["rewards"]) for path in paths]
+            if is_batch:
+                average_discounted_return = np.mean(paths.first_steps(returns))
+                undiscounted_returns = paths.reduce_per_path(rewards)
+            else:
+                average_discounted_return = \
+                    np.mean([path["returns"][0] for path in paths])
+                undiscounted_returns = [sum(path["rewards"]) for path in paths]
 
             ent = np.mean(self.algo.policy.distribution.entropy(agent_infos))
 
@@ -0,0 +1,258 @@
+import queue
+import sys
+import threading
+import traceback
+
+import numpy as np
+# import pickle
+import cloudpickle as pickle
+
+from rllab.misc import logger
+from rllab.sampler import parallel_sampler
+from rllab.sampler.base import BaseSampler
+from rllab.sampler.path_batch import PathBatch
+from rllab.sampler.shared_memory import create_shm_file, remove_shm_file, _owned_files
+from rllab.sampler.stateful_pool import singleton_pool
+
+# sent through the request queue to stop the server
+_STOP = -1
+
+
+class _InferenceBuffers(object):
+    """
+    One slot per worker for the observation, action and agent_infos exchanged with the inference server, stored in a
+    memory-mapped file in shared memory. Pickling only sends the layout and the name of the file.
+    """
+
+    ALIGNMENT = 8
+
+    def __init__(self, n_workers, fields):
+        """
+        :param fields: list of (name, dtype, shape) of the entries of one slot
+        """
+        self.n_workers = n_workers
+        self.fields = [(name, np.dtype(dtype).str, tuple(shape)) for name, dtype, shape in fields]
+        n_bytes = sum(self._field_bytes(dtype, shape) for _, dtype, shape in self.fields)
+        self.filename = create_shm_file("rllab_inference_", n_bytes)
+        _owned_files.add(self.filename)
+        self._attach()
+
+    def _field_bytes(self, dtype, shape):
+        n_bytes = self.n_workers * int(np.prod(shape)) * np.dtype(dtype).itemsize
+        return -(-n_bytes // self.ALIGNMENT) * self.ALIGNMENT
+
+    def _attach(self):
+        self.arrays = dict()
+        offset = 0
+        for name, dtype, shape in self.fields:
+            self.arrays[name] = np.memmap(self.filename, dtype=dtype, mode='r+', offset=offset,
+                                          shape=(self.n_workers,) + shape)
+            offset += self._field_bytes(dtype, shape)
+
+    def __getstate__(self):
+        return dict(n_workers=self.n_workers, fields=self.fields, filename=self.filename)
+
+    def __setstate__(self, d):
+        self.__dict__.update(d)
+        self._attach()
+
+    def __getitem__(self, name):
+        return self.arrays[name]
+
+    def close(self):
+        remove_shm_file(self.filename)
+        _owned_files.discard(self.filename)
+
+
+class RemotePolicy(object):
+    """
+    Stand-in for the policy on the workers: get_action writes the observation into the slot of the worker, and waits
+    for the inference server to fill in the action and the agent_infos.
+    """
+
+    def __init__(self, buffers, observation_space, agent_info_keys):
+        self.buffers = buffers
+        self.observation_space = observation_space
+        self.agent_info_keys = agent_info_keys
+
+    @property
+    def recurrent(self):
+        return False
+
+    def reset(self):
+        pass
+
+    def get_action(self, observation):
+        worker_id = singleton_pool.G.worker_id
+        self.buffers["observations"][worker_id] = self.observation_space.flatten(observation)
+        singleton_pool.inference_requests.put(worker_id)
+        singleton_pool.inference_ready[worker_id].acquire()
+        if self.buffers["status"][worker_id] != 0:
+            raise RuntimeError("The inference server failed to compute the action; see the log of the master")
+        action = np.array(self.buffers["actions"][worker_id])
+        agent_info = {k: np.array(self.buffers["agent_info_" + k][worker_id]) for k in self.agent_info_keys}
+        return action, agent_info
+
+    def terminate(self):
+        pass
+
+
+class InferenceServer(object):
+    """
+    Computes the actions of all the workers of the pool with one policy.get_actions call per batch of requests. It
+    runs in a thread of the master, with its own copy of the policy, so that the master can update its policy while
+    the workers are sampling (see BatchPolopt(pipelined=True)).
+    """
+
+    def __init__(self, policy, observation_space):
+        assert not policy.recurrent, "The inference server only supports non-recurrent policies"
+        assert singleton_pool.n_parallel > 1 and singleton_pool.supports_shared_memory, \
+            "The inference server needs a local worker pool"
+        self.policy = pickle.loads(pickle.dumps(policy))
+        self.observation_space = observation_space
+        # the layout of the slots is taken from the output of the policy on a sample observation
+        actions, agent_infos = self.policy.get_actions([observation_space.sample()])
+        actions = np.asarray(actions)
+        self.agent_info_keys = sorted(agent_infos.keys())
+        fields = [
+            ("observations", np.float64, (observation_space.flat_dim,)),
+            ("actions", actions.dtype, actions.shape[1:]),
+            ("status", np.int8, ()),
+        ]
+        for k in self.agent_info_keys:
+            value = np.asarray(agent_infos[k])
+            fields.append(("agent_info_" + k, value.dtype, value.shape[1:]))
+        self.buffers = _InferenceBuffers(singleton_pool.n_parallel, fields)
+        self.n_requests = 0
+        self.n_batches = 0
+        self._thread = None
+
+    def make_remote_policy(self):
+        return RemotePolicy(self.buffers, self.observation_space, self.agent_info_keys)
+
+    def set_param_values(self, params):
+        """ Must only be called when no collection is running. """
+        self.policy.set_param_values(params)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._serve)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _serve(self):
+        requests = singleton_pool.inference_requests
+        ready = singleton_pool.inference_ready
+        status = self.buffers["status"]
+        failed = False
+        while True:
+            worker_ids = [requests.get()]
+            # batch all the requests that are already waiting
+            while True:
+                try:
+                    worker_ids.append(requests.get_nowait())
+                except queue.Empty:
+                    break
+            stop = _STOP in worker_ids
+            worker_ids = [i for i in worker_ids if i != _STOP]
+            if worker_ids:
+                if not failed:
+                    try:
+                        self._compute_actions(worker_ids)
+                    except Exception:
+                        logger.log("Inference server failed:\n" +
+                                   "".join(traceback.format_exception(*sys.exc_info())))
+                        failed = True
+                status[worker_ids] = 1 if failed else 0
+                self.n_requests += len(worker_ids)
+                self.n_batches += 1
+                for i in worker_ids:
+                    ready[i].release()
+            if stop:
+                return
+
+    def _compute_actions(self, worker_ids):
+        flat_obs = np.array(self.buffers["observations"][worker_ids])
+        actions, agent_infos = self.policy.get_actions(self.observation_space.unflatten_n(flat_obs))
+        self.buffers["actions"][worker_ids] = actions
+        for k in self.agent_info_keys:
+            self.buffers["agent_info_" + k][worker_ids] = agent_infos[k]
+
+    def pop_mean_batch_size(self):
+        """ Mean number of requests per policy call since the last call to this method. """
+        mean = self.n_requests / max(self.n_batches, 1)
+        self.n_requests = 0
+        self.n_batches = 0
+        return mean
+
+    def stop(self):
+        if self._thread is not None:
+            singleton_pool.inference_requests.put(_STOP)
+            self._thread.join()
+            self._thread = None
+        self.buffers.close()
+        self.policy.terminate()
+
+
+class InferenceServerSampler(BaseSampler):
+    """
+    Sampler whose workers only hold the env: the actions of all the workers are computed on the master by an
+    InferenceServer, which batches the observations sent by the workers at each step. Without a worker pool, the
+    paths are sampled with the policy directly.
+    """
+
+    def __init__(self, algo, shared_transport=False):
+        """
+        :type algo: BatchPolopt
+        :param shared_transport: send the paths from the workers back to the master through shared memory instead
+        of pickling them
+        """
+        super(InferenceServerSampler, self).__init__(algo)
+        self.shared_transport = shared_transport
+        self.server = None
+
+    def start_worker(self):
+        if singleton_pool.n_parallel > 1:
+            self.server = InferenceServer(self.algo.policy, self.algo.env.observation_space)
+            self.server.start()
+            parallel_sampler.populate_task(self.algo.env, self.server.make_remote_policy(), scope=self.algo.scope)
+        else:
+            parallel_sampler.populate_task(self.algo.env, self.algo.policy, scope=self.algo.scope)
+
+    def shutdown_worker(self):
+        parallel_sampler.terminate_task(scope=self.algo.scope)
+        if self.server is not None:
+            self.server.stop()
+            self.server = None
+
+    def obtain_samples(self, itr):
+        return self.obtain_samples_async(itr).get()
+
+    def obtain_samples_async(self, itr):
+        if self.server is None:
+            handle = parallel_sampler.sample_paths_async(
+                policy_params=self.algo.policy.get_param_values(),
+                max_samples=self.algo.batch_size,
+                max_path_length=self.algo.max_path_length,
+                scope=self.algo.scope,
+            )
+        else:
+            self.server.set_param_values(self.algo.policy.get_param_values())
+            path_transport = parallel_sampler.get_path_transport(self.algo.scope) if self.shared_transport else None
+            handle = singleton_pool.run_collect_async(
+                parallel_sampler._worker_collect_one_path,
+                threshold=self.algo.batch_size,
+                args=(self.algo.max_path_length, self.algo.scope, None, path_transport),
+                show_prog_bar=True
+            )
+            if path_transport is not None:
+                handle = handle.then(path_transport.read)
+            handle = handle.then(self._record_batch_size)
+        handle = handle.then(PathBatch.from_paths)
+        if self.algo.whole_paths:
+            return handle
+        else:
+            return handle.then(lambda paths: parallel_sampler.truncate_paths(paths, self.algo.batch_size))
+
+    def _record_batch_size(self, paths):
+        logger.record_tabular('Sampler/InferenceBatchSize', self.server.pop_mean_batch_size())
+        return paths
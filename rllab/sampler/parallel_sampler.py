@@ -1,5 +1,9 @@
-from rllab.sampler.utils import rollout
+from rllab.sampler.utils import rollout, RolloutTimer
 from rllab.sampler.stateful_pool import singleton_pool, SharedGlobal
+from rllab.sampler.shared_memory import SharedParamChannel, SharedPathTransport
+from rllab.sampler.path_batch import PathBatch
+from rllab.core.parameterized import Parameterized
+from rllab.core.serializable import Serializable
 from rllab.misc import ext
 from rllab.misc import logger
 from rllab.misc import tensor_utils
@@ -7,6 +11,8 @@ from rllab.misc import tensor_utils
 import cloudpickle as pickle
 import numpy as np
 import tensorflow as tf
+import hashlib
+import time
 
 
 def _worker_init(G, id):
@@ -19,6 +25,18 @@ def _worker_init(G, id):
 
 def initialize(n_parallel):
     singleton_pool.initialize(n_parallel)
+    _populated_fingerprints.clear()
+    singleton_pool.run_each(_worker_init, [(id,) for id in range(singleton_pool.n_parallel)])
+
+
+def initialize_socket(n_workers, host="localhost", port=0, authkey=None, launch_local=False):
+    """
+    Same as initialize, but with workers connected over TCP, possibly from other machines (see
+    StatefulPool.initialize_socket). The shared-memory parameter channel and path transport are not available with
+    these workers, so the parameters and paths are pickled instead.
+    """
+    singleton_pool.initialize_socket(n_workers, host=host, port=port, authkey=authkey, launch_local=launch_local)
+    _populated_fingerprints.clear()
     singleton_pool.run_each(_worker_init, [(id,) for id in range(singleton_pool.n_parallel)])
 
 
@@ -33,10 +51,40 @@ def _get_scoped_G(G, scope):
     return G.scopes[scope]
 
 
-def _worker_populate_task(G, env, policy, scope=None):
+def _worker_populate_task(G, env, policy, scope=None, fingerprints=None):
     G = _get_scoped_G(G, scope)
     G.env = pickle.loads(env)
     G.policy = pickle.loads(policy)
+    G.params_version = None
+    G.fingerprints = fingerprints
+
+
+def _worker_update_task(G, fingerprints, env, env_delta, policy, policy_params, scope=None):
+    """
+    Bring an already populated worker up to date: env and policy are only shipped (pickled) when their fingerprint
+    changed, otherwise the env delta and the policy parameters are applied to the objects the worker holds.
+    :return: False if the worker does not hold the expected objects, in which case nothing is changed
+    """
+    G = _get_scoped_G(G, scope)
+    old_fingerprints = getattr(G, "fingerprints", None)
+    if old_fingerprints is None or (env is None and old_fingerprints[0] != fingerprints[0]) or \
+            (policy is None and old_fingerprints[1] != fingerprints[1]):
+        return False
+    if env is not None:
+        if G.env is not None:
+            G.env.terminate()
+        G.env = pickle.loads(env)
+    else:
+        _apply_env_delta(G.env, pickle.loads(env_delta))
+    if policy is not None:
+        if G.policy is not None:
+            G.policy.terminate()
+        G.policy = pickle.loads(policy)
+    elif policy_params is not None:
+        G.policy.set_param_values(policy_params)
+    G.params_version = None
+    G.fingerprints = fingerprints
+    return True
 
 
 def _worker_terminate_task(G, scope=None):
@@ -47,14 +95,65 @@ def _worker_terminate_task(G, scope=None):
     if getattr(G, "policy", None):
         G.policy.terminate()
         G.policy = None
+    G.fingerprints = None
+
+
+# generators of the curriculum envs, which change between algorithm instances without changing the rest of the env
+_ENV_DELTA_ATTRS = ["start_generator", "goal_generator"]
+
+
+def _get_env_delta(env):
+    return {
+        attr: getattr(env, attr) for attr in _ENV_DELTA_ATTRS
+        if hasattr(env, attr) and hasattr(env, "update_" + attr)
+    }
+
+
+def _apply_env_delta(env, delta):
+    for attr, value in delta.items():
+        getattr(env, "update_" + attr)(value)
+
+
+def _fingerprint(data):
+    return hashlib.md5(data).hexdigest()
+
+
+def _env_fingerprint(env):
+    """
+    Fingerprint of the env content, leaving out the part returned by _get_env_delta.
+    """
+    delta = _get_env_delta(env)
+    try:
+        _apply_env_delta(env, {attr: None for attr in delta})
+        return _fingerprint(pickle.dumps(env)), delta
+    finally:
+        _apply_env_delta(env, delta)
+
+
+def _policy_fingerprint(policy):
+    """
+    Fingerprint of the policy structure: the parameter values of a Parameterized policy are left out.
+    """
+    if isinstance(policy, Parameterized):
+        return _fingerprint(pickle.dumps(Serializable.__getstate__(policy)))
+    return _fingerprint(pickle.dumps(policy))
 
 
 _cached_populate_env = dict()
 _cached_populate_policy = dict()
+# fingerprints of the env and policy held by the workers of each scope
+_populated_fingerprints = dict()
 
 
-def populate_task(env, policy, scope=None):
-    if scope in _cached_populate_env and scope in _cached_populate_policy:
+def populate_task(env, policy, scope=None, refresh=False):
+    """
+    Send the env and policy to the workers. If the workers already hold an env and a policy with the same
+    fingerprints for this scope (e.g. kept by terminate_task(persistent=True)), only the start/goal generators of the
+    env and the policy parameters are sent.
+    :param refresh: compare the fingerprints even if env and policy are the objects populated last time for this
+    scope, so that their generators and parameters are sent again if they were modified in place
+    """
+    if not refresh and scope in _cached_populate_env and scope in _cached_populate_policy:
         if _cached_populate_env[scope] is env and _cached_populate_policy[scope] is policy:
             # already populated; return
             return
@@ -62,10 +161,29 @@ def populate_task(env, policy, scope=None):
     _cached_populate_env[scope] = env
     _cached_populate_policy[scope] = policy
     if singleton_pool.n_parallel > 1:
-        singleton_pool.run_each(
-            _worker_populate_task,
-            [(pickle.dumps(env), pickle.dumps(policy), scope)] * singleton_pool.n_parallel
-        )
+        env_fingerprint, env_delta = _env_fingerprint(env)
+        fingerprints = (env_fingerprint, _policy_fingerprint(policy))
+        old_fingerprints = _populated_fingerprints.get(scope, None)
+        updated = False
+        if old_fingerprints is not None:
+            env_changed = old_fingerprints[0] != fingerprints[0]
+            policy_changed = old_fingerprints[1] != fingerprints[1]
+            policy_params = policy.get_param_values() if isinstance(policy, Parameterized) else None
+            updated = all(singleton_pool.run_each(
+                _worker_update_task,
+                [(fingerprints,
+                  pickle.dumps(env) if env_changed else None,
+                  pickle.dumps(env_delta),
+                  pickle.dumps(policy) if policy_changed else None,
+                  policy_params,
+                  scope)] * singleton_pool.n_parallel
+            ))
+        if not updated:
+            singleton_pool.run_each(
+                _worker_populate_task,
+                [(pickle.dumps(env), pickle.dumps(policy), scope, fingerprints)] * singleton_pool.n_parallel
+            )
+        _populated_fingerprints[scope] = fingerprints
     else:
         # avoid unnecessary copying
         G = _get_scoped_G(singleton_pool.G, scope)
@@ -74,13 +192,23 @@ def populate_task(env, policy, scope=None):
     logger.log("Populated")
 
 
-def terminate_task(scope=None):
-    singleton_pool.run_each(
-        _worker_terminate_task,
-        [(scope,)] * singleton_pool.n_parallel
-    )
+def terminate_task(scope=None, persistent=False):
+    """
+    :param persistent: keep the env and policy on the workers, so that a later populate_task for this scope only
+    sends what changed
+    """
+    if not persistent:
+        singleton_pool.run_each(
+            _worker_terminate_task,
+            [(scope,)] * singleton_pool.n_parallel
+        )
+        _populated_fingerprints.pop(scope, None)
     del _cached_populate_env[scope]
     del _cached_populate_policy[scope]
+    if scope in _param_channels:
+        _param_channels.pop(scope).close()
+    if scope in _path_transports:
+        _path_transports.pop(scope).close()
 
 
 def _worker_set_seed(_, seed):
@@ -100,15 +228,113 @@ def _worker_set_policy_params(G, params, scope=None):
     G.policy.set_param_values(params)
 
 
+def _worker_sync_policy_params(G, params_channel):
+    """
+    Load the policy parameters from the shared channel if they changed since the last sync. G must already be scoped.
+    """
+    if params_channel is None:
+        return
+    version = (params_channel.filename, params_channel.version)
+    if getattr(G, "params_version", None) != version:
+        G.policy.set_param_values(params_channel.read())
+        G.params_version = version
+
+
+_param_channels = dict()
+
+
+def broadcast_policy_params(policy_params, scope=None):
+    """
+    Make the policy parameters available to the workers. With a worker pool they are written once into a shared
+    memory channel, which has to be passed to the worker functions so that they can load them lazily with
+    _worker_sync_policy_params. Without a pool, or with remote workers, the parameters are set directly and None is
+    returned.
+    :param policy_params: flat parameter vector
+    :return: the channel holding the parameters, or None
+    """
+    if singleton_pool.n_parallel > 1 and singleton_pool.supports_shared_memory:
+        channel = _param_channels.get(scope, None)
+        if channel is None or channel.size != policy_params.size or channel.dtype != policy_params.dtype.str:
+            if channel is not None:
+                channel.close()
+            channel = SharedParamChannel(policy_params.size, policy_params.dtype)
+            _param_channels[scope] = channel
+        channel.write(policy_params)
+        return channel
+    singleton_pool.run_each(
+        _worker_set_policy_params,
+        [(policy_params, scope)] * singleton_pool.n_parallel
+    )
+    return None
+
+
 def _worker_set_env_params(G, params, scope=None):
     G = _get_scoped_G(G, scope)
     G.env.set_param_values(params)
 
 
-def _worker_collect_one_path(G, max_path_length, scope=None):
+def _worker_collect_one_path(G, max_path_length, scope=None, params_channel=None, path_transport=None, timed=False,
+                             recording=None):
+    worker_id = getattr(G, "worker_id", 0)
     G = _get_scoped_G(G, scope)
-    path = rollout(G.env, G.policy, max_path_length)
-    return path, len(path["rewards"])
+    _worker_sync_policy_params(G, params_channel)
+    if not timed:
+        path = rollout(G.env, G.policy, max_path_length, preallocate=True, recording=recording)
+        n_samples = len(path["rewards"])
+        if path_transport is not None:
+            path = path_transport.write(path)
+        return path, n_samples
+    start = time.perf_counter()
+    timer = RolloutTimer()
+    path = rollout(G.env, G.policy, max_path_length, preallocate=True, timer=timer, recording=recording)
+    n_samples = len(path["rewards"])
+    serialization_start = time.perf_counter()
+    if path_transport is not None:
+        path = path_transport.write(path)
+    elif singleton_pool.n_parallel > 1:
+        # pickle here rather than when the pool sends the result back, so that it can be timed
+        path = pickle.dumps(path)
+    timer.serialization += time.perf_counter() - serialization_start
+    stats = timer.as_dict()
+    stats["total"] = time.perf_counter() - start
+    return (path, worker_id, stats), n_samples
+
+
+def _gather_timed_paths(results, path_transport):
+    """
+    Split the results of timed collections into the paths and the per-worker statistics: a dictionary from the
+    worker id to the total of each timer and the number of paths collected by the worker.
+    """
+    paths = []
+    worker_stats = dict()
+    for path, worker_id, stats in results:
+        if isinstance(path, bytes):
+            path = pickle.loads(path)
+        paths.append(path)
+        totals = worker_stats.setdefault(worker_id, dict(dict.fromkeys(stats.keys(), 0.), n_paths=0))
+        for key, value in stats.items():
+            totals[key] += value
+        totals["n_paths"] += 1
+    if path_transport is not None:
+        paths = path_transport.read(paths)
+    return paths, worker_stats
+
+
+_path_transports = dict()
+
+
+def get_path_transport(scope=None):
+    """
+    Return the shared-memory transport used to send the paths of this scope back to the master, or None if there is
+    no worker pool or the workers are remote. The transport is ready for a new collection.
+    """
+    if singleton_pool.n_parallel <= 1 or not singleton_pool.supports_shared_memory:
+        return None
+    if scope not in _path_transports:
+        _path_transports[scope] = SharedPathTransport()
+    transport = _path_transports[scope]
+    transport.new_collection()
+    return transport
 
 
 # def _worker_collect_one_path_snn(G, max_path_length, switch_lat_every=0, scope=None):
@@ -121,40 +347,79 @@ def sample_paths(
         max_samples,
         max_path_length=np.inf,
         env_params=None,
-        scope=None):
+        scope=None,
+        shared_transport=False,
+        timed=False,
+        recording=None):
     """
     :param policy_params: parameters for the policy. This will be updated on each worker process
     :param max_samples: desired maximum number of samples to be collected. The actual number of collected samples
     might be greater since all trajectories will be rolled out either until termination or until max_path_length is
     reached
     :param max_path_length: horizon / maximum length of a single trajectory
-    :return: a list of collected paths
+    :param shared_transport: whether the workers send the paths back through shared memory (see
+    SharedPathTransport) instead of pickling them
+    :param timed: time the env steps, policy inference, resets and serialization on the workers
+    :param recording: optional RecordingSpec selecting the env_info and agent_info entries the workers keep in the
+    paths (see rllab.sampler.utils.rollout)
+    :return: a list of collected paths, or if timed a pair of this list and the per-worker statistics (see
+    _gather_timed_paths)
     """
-    singleton_pool.run_each(
-        _worker_set_policy_params,
-        [(policy_params, scope)] * singleton_pool.n_parallel
-    )
+    return sample_paths_async(
+        policy_params,
+        max_samples,
+        max_path_length=max_path_length,
+        env_params=env_params,
+        scope=scope,
+        shared_transport=shared_transport,
+        timed=timed,
+        recording=recording,
+    ).get()
+
+
+def sample_paths_async(
+        policy_params,
+        max_samples,
+        max_path_length=np.inf,
+        env_params=None,
+        scope=None,
+        shared_transport=False,
+        timed=False,
+        recording=None):
+    """
+    Same as sample_paths, but return a CollectHandle right away; its get() method returns what sample_paths
+    returns. See StatefulPool.run_collect_async.
+    """
+    params_channel = broadcast_policy_params(policy_params, scope)
     if env_params is not None:
         singleton_pool.run_each(
             _worker_set_env_params,
             [(env_params, scope)] * singleton_pool.n_parallel
         )
-    return singleton_pool.run_collect(
+    path_transport = get_path_transport(scope) if shared_transport else None
+    handle = singleton_pool.run_collect_async(
         _worker_collect_one_path,
         threshold=max_samples,
-        args=(max_path_length, scope),
+        args=(max_path_length, scope, params_channel, path_transport, timed, recording),
         show_prog_bar=True
     )
+    if timed:
+        handle = handle.then(lambda results: _gather_timed_paths(results, path_transport))
+    elif path_transport is not None:
+        handle = handle.then(path_transport.read)
+    return handle
 
 
 def truncate_paths(paths, max_samples):
     """
     Truncate the list of paths so that the total number of samples is exactly equal to max_samples. This is done by
     removing extra paths at the end of the list, and make the last path shorter if necessary
-    :param paths: a list of paths
+    :param paths: a list of paths, or a PathBatch
     :param max_samples: the absolute maximum number of samples
     :return: a list of paths, truncated so that the number of samples adds up to max-samples
     """
+    if isinstance(paths, PathBatch):
+        return paths.truncate(max_samples)
     # chop samples collected by extra paths
     # make a copy
     paths = list(paths)
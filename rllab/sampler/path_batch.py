@@ -0,0 +1,166 @@
+import numpy as np
+
+# keys of a path whose leaves hold one entry per time step
+PER_STEP_KEYS = ["observations", "actions", "rewards", "dones", "agent_infos", "env_infos"]
+
+
+def flatten_path(path, prefix=()):
+    """ List of (key tuple, value) pairs of the leaves of a nested path dict. """
+    leaves = []
+    for k, v in path.items():
+        if isinstance(v, dict):
+            leaves.extend(flatten_path(v, prefix + (k,)))
+        else:
+            leaves.append((prefix + (k,), v))
+    return leaves
+
+
+def set_leaf(path, key, value):
+    for k in key[:-1]:
+        path = path.setdefault(k, dict())
+    path[key[-1]] = value
+
+
+def _slice_columns(columns, start, end):
+    return {
+        k: _slice_columns(v, start, end) if isinstance(v, dict) else v[start:end]
+        for k, v in columns.items()
+    }
+
+
+def _merge(path, extras):
+    for k, v in extras.items():
+        if isinstance(v, dict):
+            _merge(path.setdefault(k, dict()), v)
+        else:
+            path[k] = v
+
+
+class PathBatch(object):
+    """
+    Struct-of-arrays batch of paths. Each per-step entry of the paths (observations, actions, rewards, dones and the
+    entries of agent_infos and env_infos) is stored as one contiguous array over all the steps of the batch, in the
+    nested dict columns, and path i spans the steps offsets[i]:offsets[i + 1]. The other entries of the paths (e.g.
+    last_obs) are kept per path in extras.
+
+    Indexing and iterating yield per-path dicts of views into the columns, so that a PathBatch can be used in place of
+    a list of paths, while code aware of it can use the columns directly instead of concatenating the paths again.
+    """
+
+    def __init__(self, columns, offsets, extras=None):
+        self.columns = columns
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        if extras is None:
+            extras = [dict() for _ in range(len(self))]
+        self.extras = extras
+        self._views = dict()
+
+    @classmethod
+    def from_paths(cls, paths):
+        """ Build a batch from a list of paths, copying their per-step entries into the columns. """
+        if isinstance(paths, PathBatch):
+            return paths
+        offsets = np.concatenate([[0], np.cumsum([len(path["rewards"]) for path in paths])]).astype(np.int64)
+        leaves = [dict(flatten_path(path)) for path in paths]
+        # per-step entries present in all the paths with the same trailing shape become columns
+        column_keys = []
+        if len(paths) > 0:
+            for key, value in leaves[0].items():
+                if key[0] not in PER_STEP_KEYS:
+                    continue
+                shapes = set()
+                for path_leaves in leaves:
+                    other = path_leaves.get(key, None)
+                    shapes.add(None if other is None else np.shape(other)[1:])
+                if None not in shapes and len(shapes) == 1 and not np.asarray(value).dtype.hasobject:
+                    column_keys.append(key)
+        columns = dict()
+        for key in column_keys:
+            set_leaf(columns, key, np.concatenate([path_leaves[key] for path_leaves in leaves]))
+        extras = []
+        for path_leaves in leaves:
+            path_extras = dict()
+            for key, value in path_leaves.items():
+                if key not in column_keys:
+                    set_leaf(path_extras, key, value)
+            extras.append(path_extras)
+        return cls(columns, offsets, extras)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def n_samples(self):
+        return int(self.offsets[-1])
+
+    @property
+    def path_lengths(self):
+        return np.diff(self.offsets)
+
+    def _path(self, i):
+        if i not in self._views:
+            path = _slice_columns(self.columns, self.offsets[i], self.offsets[i + 1])
+            _merge(path, self.extras[i])
+            # an info dict left without entries, e.g. by a RecordingSpec, has no leaf to be stored with
+            for key in ["agent_infos", "env_infos"]:
+                path.setdefault(key, dict())
+            self._views[i] = path
+        return self._views[i]
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            start, stop, step = idx.indices(len(self))
+            assert step == 1, "PathBatch only supports contiguous slices"
+            return self.select(start, max(start, stop))
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError("path index out of range")
+        return self._path(idx)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self._path(i)
+
+    def select(self, start, stop):
+        """ Batch of the paths start to stop - 1, sharing the columns of this batch. """
+        begin, end = self.offsets[start], self.offsets[stop]
+        return PathBatch(
+            _slice_columns(self.columns, begin, end),
+            self.offsets[start:stop + 1] - begin,
+            self.extras[start:stop],
+        )
+
+    def truncate(self, max_samples):
+        """
+        Same as parallel_sampler.truncate_paths: drop the extra paths at the end, and shorten the last one so that the
+        batch holds at most max_samples samples. The columns of the result are views into those of this batch.
+        """
+        n_samples = min(max_samples, self.n_samples)
+        n_paths = min(int(np.searchsorted(self.offsets, n_samples, side='left')), len(self))
+        offsets = self.offsets[:n_paths + 1].copy()
+        if n_paths > 0:
+            offsets[-1] = n_samples
+        return PathBatch(_slice_columns(self.columns, 0, n_samples), offsets, self.extras[:n_paths])
+
+    def add_column(self, key, values):
+        """ Add a per-step entry, e.g. the advantages, to the columns and to the per-path views. """
+        set_leaf(self.columns, key if isinstance(key, tuple) else (key,), values)
+        for i, path in self._views.items():
+            set_leaf(path, key if isinstance(key, tuple) else (key,), values[self.offsets[i]:self.offsets[i + 1]])
+
+    def reduce_per_path(self, values, ufunc=np.add):
+        """ Apply ufunc.reduceat to a column over the steps of each path; all the paths must be non-empty. """
+        assert np.all(self.path_lengths > 0)
+        return ufunc.reduceat(values, self.offsets[:-1], axis=0)
+
+    def first_steps(self, values):
+        """ Value of a column at the first step of each path. """
+        return values[self.offsets[:-1]]
+
+    def __getstate__(self):
+        return dict(columns=self.columns, offsets=self.offsets, extras=self.extras)
+
+    def __setstate__(self, d):
+        self.__dict__.update(d)
+        self._views = dict()
@@ -0,0 +1,244 @@
+import atexit
+import os
+import tempfile
+import uuid
+
+import numpy as np
+
+from rllab.sampler.path_batch import PathBatch, PER_STEP_KEYS, flatten_path, set_leaf
+
+
+def shm_dir():
+    """
+    Directory used for the memory-mapped files shared between the master and the workers. /dev/shm keeps them in
+    memory on Linux; elsewhere we fall back to the default temporary directory.
+    """
+    if os.path.isdir("/dev/shm"):
+        return "/dev/shm"
+    return tempfile.gettempdir()
+
+
+def create_shm_file(prefix, n_bytes):
+    fd, filename = tempfile.mkstemp(prefix=prefix, dir=shm_dir())
+    try:
+        os.ftruncate(fd, max(n_bytes, 1))
+    finally:
+        os.close(fd)
+    return filename
+
+
+def remove_shm_file(filename):
+    try:
+        os.unlink(filename)
+    except OSError:
+        pass
+
+
+# channels created by this process, which is responsible for removing their files
+_owned_files = set()
+
+
+@atexit.register
+def _remove_owned_files():
+    for filename in list(_owned_files):
+        remove_shm_file(filename)
+    _owned_files.clear()
+
+
+class SharedParamChannel(object):
+    """
+    A versioned flat parameter vector stored in a memory-mapped file in shared memory. The master writes the
+    parameters once per update and bumps the version; workers attach to the file by name (pickling the channel only
+    sends its name) and reload the parameters only when they see a new version.
+    """
+
+    # bytes reserved for the version counter in front of the values
+    HEADER_BYTES = 8
+
+    def __init__(self, size, dtype):
+        self.size = size
+        self.dtype = np.dtype(dtype).str
+        self.filename = create_shm_file("rllab_params_", self.HEADER_BYTES + size * np.dtype(dtype).itemsize)
+        _owned_files.add(self.filename)
+        self._attach()
+        self._version[0] = 0
+
+    def _attach(self):
+        self._version = np.memmap(self.filename, dtype=np.int64, mode='r+', shape=(1,))
+        self._values = np.memmap(self.filename, dtype=self.dtype, mode='r+', offset=self.HEADER_BYTES,
+                                 shape=(self.size,))
+
+    def __getstate__(self):
+        return dict(size=self.size, dtype=self.dtype, filename=self.filename)
+
+    def __setstate__(self, d):
+        self.__dict__.update(d)
+        self._attach()
+
+    @property
+    def version(self):
+        return int(self._version[0])
+
+    def write(self, values):
+        """ Write new parameter values; must not be called while workers are reading them. """
+        self._values[:] = values
+        self._version[0] += 1
+
+    def read(self):
+        return np.array(self._values)
+
+    def close(self):
+        remove_shm_file(self.filename)
+        _owned_files.discard(self.filename)
+
+
+class _SharedPathWriter(object):
+    """
+    Worker side of SharedPathTransport: an append-only buffer file that is rewound at the beginning of every
+    collection, and doubled in size when a path does not fit.
+    """
+
+    ALIGNMENT = 8
+
+    def __init__(self, capacity):
+        self.filenames = []
+        self._new_file(capacity)
+        self.collection = None
+
+    def _new_file(self, capacity):
+        self.capacity = capacity
+        self.filenames.append(create_shm_file("rllab_paths_", capacity))
+        self.buffer = np.memmap(self.filenames[-1], dtype=np.uint8, mode='r+', shape=(capacity,))
+        self.offset = 0
+
+    def start_collection(self, collection):
+        if collection == self.collection:
+            return
+        self.collection = collection
+        # earlier files only hold paths of previous collections, which the master has already read
+        for filename in self.filenames[:-1]:
+            remove_shm_file(filename)
+        self.filenames = self.filenames[-1:]
+        if not os.path.exists(self.filenames[-1]):
+            # the master removed the file when closing its transport
+            self.filenames = []
+            self._new_file(self.capacity)
+        self.offset = 0
+
+    def write(self, path):
+        leaves = []
+        extras = []
+        n_bytes = 0
+        for key, value in flatten_path(path):
+            value = np.asarray(value)
+            if value.dtype.hasobject:
+                extras.append((key, value))
+            else:
+                value = np.ascontiguousarray(value)
+                leaves.append((key, value))
+                n_bytes += value.nbytes + self.ALIGNMENT
+        if self.offset + n_bytes > self.capacity:
+            if self.offset == 0:
+                # nothing of the current collection was written to this file, so no descriptor refers to it
+                remove_shm_file(self.filenames.pop())
+            self._new_file(max(2 * self.capacity, n_bytes))
+        fields = []
+        for key, value in leaves:
+            self.buffer[self.offset:self.offset + value.nbytes] = value.reshape(-1).view(np.uint8)
+            fields.append((key, value.dtype.str, value.shape, self.offset))
+            self.offset += -(-value.nbytes // self.ALIGNMENT) * self.ALIGNMENT
+        return dict(filename=self.filenames[-1], fields=fields, extras=extras, n_steps=len(path["rewards"]))
+
+
+_worker_path_writer = None
+
+
+class SharedPathTransport(object):
+    """
+    Transport for sending paths from the workers back to the master through shared memory instead of pickling them.
+    Each worker writes its paths into a memory-mapped buffer file that it reuses across collections, and only returns
+    a small descriptor with the offsets, dtypes and shapes of the arrays. The master builds the columns of a PathBatch
+    directly from these buffers.
+
+    The buffers live in shm_dir(), so /dev/shm has to be large enough to hold one batch of samples.
+    """
+
+    def __init__(self, initial_capacity=2 ** 24):
+        self.initial_capacity = initial_capacity
+        self.transport_id = uuid.uuid4().hex
+        self.generation = 0
+        self._filenames = set()
+
+    def __getstate__(self):
+        return dict(initial_capacity=self.initial_capacity, transport_id=self.transport_id,
+                    generation=self.generation)
+
+    def __setstate__(self, d):
+        self.__dict__.update(d)
+
+    def new_collection(self):
+        """ Called by the master before dispatching a collection; the buffers are then reused by the workers. """
+        self.generation += 1
+
+    def write(self, path):
+        """ Called by the workers: write the path to the worker buffer and return its descriptor. """
+        global _worker_path_writer
+        if _worker_path_writer is None:
+            _worker_path_writer = _SharedPathWriter(self.initial_capacity)
+        _worker_path_writer.start_collection((self.transport_id, self.generation))
+        return _worker_path_writer.write(path)
+
+    def read(self, descriptors):
+        """
+        Called by the master once all the workers are done: rebuild the paths from their descriptors, as a PathBatch.
+        """
+        buffers = dict()
+        for descriptor in descriptors:
+            filename = descriptor["filename"]
+            if filename not in buffers:
+                buffers[filename] = np.memmap(filename, dtype=np.uint8, mode='r')
+                self._filenames.add(filename)
+                _owned_files.add(filename)
+
+        def view(filename, dtype, shape, offset):
+            n_bytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+            return buffers[filename][offset:offset + n_bytes].view(dtype).reshape(shape)
+
+        # per-step keys shared by all the paths with a consistent dtype and shape are gathered in one column each
+        columns = dict()
+        for descriptor in descriptors:
+            for key, dtype, shape, _ in descriptor["fields"]:
+                if key[0] in PER_STEP_KEYS:
+                    columns.setdefault(key, []).append((dtype, shape[1:]))
+        column_keys = [
+            key for key, specs in columns.items()
+            if len(specs) == len(descriptors) and len(set(specs)) == 1
+        ]
+        offsets = np.concatenate([[0], np.cumsum([descriptor["n_steps"] for descriptor in descriptors])])
+        arrays = dict()
+        for key in column_keys:
+            dtype, trailing_shape = columns[key][0]
+            arrays[key] = np.empty((offsets[-1],) + tuple(trailing_shape), dtype=dtype)
+
+        extras = []
+        for i, descriptor in enumerate(descriptors):
+            path_extras = dict()
+            start, end = offsets[i], offsets[i + 1]
+            for key, dtype, shape, offset in descriptor["fields"]:
+                if key in arrays:
+                    arrays[key][start:end] = view(descriptor["filename"], dtype, shape, offset)
+                else:
+                    set_leaf(path_extras, key, np.array(view(descriptor["filename"], dtype, shape, offset)))
+            for key, value in descriptor["extras"]:
+                set_leaf(path_extras, key, value)
+            extras.append(path_extras)
+        batch_columns = dict()
+        for key, array in arrays.items():
+            set_leaf(batch_columns, key, array)
+        return PathBatch(batch_columns, offsets, extras)
+
+    def close(self):
+        for filename in self._filenames:
+            remove_shm_file(filename)
+            _owned_files.discard(filename)
+        self._filenames = set()
@@ -0,0 +1,284 @@
+"""
+Socket-based backend for StatefulPool, running the workers as separate processes that can live on other machines.
+
+Start the master with parallel_sampler.initialize_socket (or StatefulPool.initialize_socket), then start one worker
+per core on each machine with
+
+    RLLAB_SOCKET_AUTHKEY=<key> python -m rllab.sampler.socket_pool --host <master host> --port <master port>
+
+The workers need the same code base as the master. Messages are authenticated with the shared authkey but are not
+encrypted, and they are unpickled by the workers, so only run this on a trusted network.
+"""
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import threading
+import traceback
+from multiprocessing.connection import Listener, Client, wait
+
+import cloudpickle
+
+from rllab.misc import logger
+
+AUTHKEY_ENV = "RLLAB_SOCKET_AUTHKEY"
+
+
+def _send(conn, obj):
+    conn.send_bytes(cloudpickle.dumps(obj))
+
+
+def _recv(conn):
+    return cloudpickle.loads(conn.recv_bytes())
+
+
+class RemoteWorkerError(Exception):
+    pass
+
+
+class SocketPool(object):
+    """
+    Master side of the socket backend. Implements the run_each / run_map / run_imap_unordered / run_collect_async
+    contract of StatefulPool over one connection per worker.
+    """
+
+    def __init__(self, n_workers, host="localhost", port=0, authkey=None):
+        """
+        :param n_workers: number of workers to wait for in accept_workers
+        :param host: interface to listen on; use "0.0.0.0" to accept workers from other machines
+        :param port: port to listen on; 0 picks a free one (see self.address)
+        :param authkey: bytes shared with the workers
+        """
+        self.n_workers = n_workers
+        self.authkey = authkey if authkey is not None else os.urandom(16)
+        self.listener = Listener((host, port), authkey=self.authkey)
+        self.address = self.listener.address
+        self.conns = []
+        self.worker_hosts = []
+
+    def accept_workers(self):
+        logger.log("Waiting for {} workers on {}:{}".format(self.n_workers, *self.address))
+        while len(self.conns) < self.n_workers:
+            conn = self.listener.accept()
+            hostname, pid = _recv(conn)
+            self.conns.append(conn)
+            self.worker_hosts.append((hostname, pid))
+            logger.log("Worker {} registered from {} (pid {})".format(len(self.conns) - 1, hostname, pid))
+        for worker_id, conn in enumerate(self.conns):
+            _send(conn, ("setup", worker_id, self.n_workers))
+
+    def _get_result(self, conn):
+        msg = _recv(conn)
+        if msg[0] == "error":
+            raise RemoteWorkerError(msg[1])
+        return msg[1]
+
+    def _get_results(self, conns):
+        """
+        Read the reply of each of the connections, and only then raise the first error, so that no reply is left for
+        the next call to read.
+        """
+        results = []
+        error = None
+        for conn in conns:
+            try:
+                results.append(self._get_result(conn))
+            except RemoteWorkerError as e:
+                results.append(None)
+                if error is None:
+                    error = e
+        if error is not None:
+            raise error
+        return results
+
+    def run_each(self, runner, args_list):
+        conns = []
+        for conn, args in zip(self.conns, args_list):
+            _send(conn, ("run", runner, args))
+            conns.append(conn)
+        return self._get_results(conns)
+
+    def run_imap_unordered(self, runner, args_list):
+        """
+        Dispatch the tasks to the idle workers, yielding (task index, result) pairs as they complete. Once a task
+        fails, no other task is dispatched, and the error is raised when the tasks still running have replied.
+        """
+        args_list = list(args_list)
+        next_task = 0
+        running = dict()
+        error = None
+        for conn in self.conns:
+            if next_task == len(args_list):
+                break
+            _send(conn, ("run", runner, args_list[next_task]))
+            running[conn] = next_task
+            next_task += 1
+        try:
+            while running:
+                for conn in wait(list(running.keys())):
+                    task = running.pop(conn)
+                    try:
+                        result = self._get_result(conn)
+                    except RemoteWorkerError as e:
+                        if error is None:
+                            error = e
+                        continue
+                    if error is not None:
+                        continue
+                    if next_task < len(args_list):
+                        _send(conn, ("run", runner, args_list[next_task]))
+                        running[conn] = next_task
+                        next_task += 1
+                    yield task, result
+        finally:
+            # tasks are still running if the caller stopped iterating early: their replies must not be read by the
+            # next call
+            for conn in running.keys():
+                try:
+                    self._get_result(conn)
+                except RemoteWorkerError:
+                    pass
+        if error is not None:
+            raise error
+
+    def run_map(self, runner, args_list):
+        args_list = list(args_list)
+        results = [None] * len(args_list)
+        for task, result in self.run_imap_unordered(runner, args_list):
+            results[task] = result
+        return results
+
+    def run_collect_async(self, collect_once, threshold, args, progress=None):
+        """
+        Start the collection on all the workers, and return a thread that counts their progress and stops them once
+        the threshold is reached. The collected objects are in thread.results once the thread is joined.
+        :param progress: optional callable receiving each increment
+        """
+        thread = _CollectThread(self.conns, collect_once, threshold, args, progress)
+        thread.start()
+        return thread
+
+    def close(self):
+        for conn in self.conns:
+            try:
+                _send(conn, ("close",))
+                conn.close()
+            except (OSError, EOFError):
+                pass
+        self.conns = []
+        self.listener.close()
+
+
+class _CollectThread(threading.Thread):
+    def __init__(self, conns, collect_once, threshold, args, progress):
+        super(_CollectThread, self).__init__()
+        self.daemon = True
+        self.conns = conns
+        self.threshold = threshold
+        self.progress = progress
+        self.results = None
+        self.error = None
+        for conn in conns:
+            _send(conn, ("collect", collect_once, threshold, args))
+
+    def run(self):
+        count = 0
+        collected = dict()
+        # once a worker failed, the others are stopped at their next increment, and their collected objects are read
+        # and dropped, so that the connections are ready for the next call
+        errors = dict()
+        try:
+            while len(collected) + len(errors) < len(self.conns):
+                for conn in wait([conn for conn in self.conns if conn not in collected and conn not in errors]):
+                    msg = _recv(conn)
+                    if msg[0] == "progress":
+                        count += msg[1]
+                        if self.progress is not None:
+                            self.progress(msg[1])
+                        stop = count >= self.threshold or len(errors) > 0
+                        _send(conn, ("stop",) if stop else ("continue",))
+                    elif msg[0] == "collected":
+                        collected[conn] = msg[1]
+                    elif msg[0] == "error":
+                        errors[conn] = RemoteWorkerError(msg[1])
+            if errors:
+                raise next(errors[conn] for conn in self.conns if conn in errors)
+            self.results = sum([collected[conn] for conn in self.conns], [])
+        except Exception as e:
+            self.error = e
+
+    def get(self):
+        self.join()
+        if self.error is not None:
+            raise self.error
+        return self.results
+
+
+def launch_local_workers(n_workers, address, authkey):
+    """
+    Start n_workers worker processes on this machine, connecting to the master at address. Mostly useful to test the
+    socket backend on a single host.
+    :return: the list of subprocess.Popen objects
+    """
+    env = dict(os.environ)
+    env[AUTHKEY_ENV] = authkey.hex()
+    host, port = address
+    if host in ["0.0.0.0", ""]:
+        host = "localhost"
+    return [
+        subprocess.Popen(
+            [sys.executable, "-m", "rllab.sampler.socket_pool", "--host", host, "--port", str(port)],
+            env=env,
+        )
+        for _ in range(n_workers)
+    ]
+
+
+def _run_worker(conn):
+    # the worker functions (e.g. in parallel_sampler) refer to the singleton pool of their own process
+    from rllab.sampler.stateful_pool import singleton_pool
+    G = singleton_pool.G
+    while True:
+        msg = _recv(conn)
+        try:
+            if msg[0] == "setup":
+                _, G.socket_worker_id, singleton_pool.n_parallel = msg
+            elif msg[0] == "run":
+                _, runner, args = msg
+                _send(conn, ("result", runner(G, *args)))
+            elif msg[0] == "collect":
+                _, collect_once, _, args = msg
+                collected = []
+                # the master replies to each increment, telling whether the threshold has been reached
+                while True:
+                    result, inc = collect_once(G, *args)
+                    collected.append(result)
+                    _send(conn, ("progress", inc))
+                    if _recv(conn)[0] == "stop":
+                        break
+                _send(conn, ("collected", collected))
+            elif msg[0] == "close":
+                return
+        except Exception:
+            _send(conn, ("error", "".join(traceback.format_exception(*sys.exc_info()))))
+
+
+def run_worker(host, port, authkey):
+    conn = Client((host, port), authkey=authkey)
+    _send(conn, (socket.gethostname(), os.getpid()))
+    try:
+        _run_worker(conn)
+    except EOFError:
+        # the master went away
+        pass
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', type=str, default='localhost', help='host of the master')
+    parser.add_argument('--port', type=int, required=True, help='port of the master')
+    args = parser.parse_args()
+    run_worker(args.host, args.port, bytes.fromhex(os.environ[AUTHKEY_ENV]))
@@ -35,16 +35,59 @@ class SharedGlobal(object):
     pass
 
 
+class CollectHandle(object):
+    """
+    Result of StatefulPool.run_collect_async. get() waits for the collection to finish and returns the collected
+    objects; deferred is True when the collection only runs once get() is called.
+    """
+
+    def __init__(self, wait, deferred=False):
+        self._wait = wait
+        self.deferred = deferred
+        self._done = False
+        self._result = None
+
+    def get(self):
+        if not self._done:
+            self._result = self._wait()
+            self._wait = None
+            self._done = True
+        return self._result
+
+    def then(self, fn):
+        """ Return a handle on fn applied to the collected objects. """
+        return CollectHandle(lambda: fn(self.get()), deferred=self.deferred)
+
+
 class StatefulPool(object):
     def __init__(self):
         self.n_parallel = 1
         self.pool = None
         self.queue = None
         self.worker_queue = None
+        self.counter = None
+        self.collect_done = None
+        # used by the workers to request actions from an InferenceServer running on the master
+        self.inference_requests = None
+        self.inference_ready = None
+        # "shared": workers bump a shared-memory counter and signal the master through an event when the threshold
+        # is reached; "manager": the previous implementation based on Manager proxies and polling
+        self.collect_mode = "shared"
+        # SocketPool when the workers are connected over TCP (see initialize_socket)
+        self.remote = None
         self.G = SharedGlobal()
 
+    @property
+    def supports_shared_memory(self):
+        """
+        Whether the workers run on this machine, so that they can exchange data with the master through files in
+        shared memory.
+        """
+        return self.remote is None
+
     def initialize(self, n_parallel):
         self.n_parallel = n_parallel
+        self._close_remote()
         if self.pool is not None:
             print("Warning: terminating existing pool")
             self.pool.terminate()
@@ -54,6 +97,11 @@ class StatefulPool(object):
         if n_parallel > 1:
             self.queue = mp.Queue()
             self.worker_queue = mp.Queue()
+            # these are inherited by the worker processes, so they have to be created before the pool
+            self.counter = mp.Value('l', 0)
+            self.collect_done = mp.Event()
+            self.inference_requests = mp.Queue()
+            self.inference_ready = [mp.Semaphore(0) for _ in range(n_parallel)]
             # FIXME: memmap is slow.
             # self.pool = MemmapingPool(
             #     self.n_parallel,
@@ -63,6 +111,34 @@ class StatefulPool(object):
                 self.n_parallel
             )
 
+    def initialize_socket(self, n_workers, host="localhost", port=0, authkey=None, launch_local=False):
+        """
+        Use n_workers worker processes connected over TCP instead of a local process pool. This blocks until all the
+        workers have registered; see rllab.sampler.socket_pool for how to start them on other machines.
+        :param host: interface to listen on; use "0.0.0.0" to accept workers from other machines
+        :param port: port to listen on; 0 picks a free one
+        :param authkey: bytes shared with the workers; a random key is generated by default
+        :param launch_local: start the workers as subprocesses of this machine
+        """
+        from rllab.sampler.socket_pool import SocketPool, launch_local_workers
+        self.initialize(1)
+        self.remote = SocketPool(n_workers, host=host, port=port, authkey=authkey)
+        if launch_local:
+            self.remote.local_workers = launch_local_workers(n_workers, self.remote.address, self.remote.authkey)
+        else:
+            print("Start the workers with: RLLAB_SOCKET_AUTHKEY={} python -m rllab.sampler.socket_pool --host "
+                  "<this host> --port {}".format(self.remote.authkey.hex(), self.remote.address[1]))
+        self.remote.accept_workers()
+        self.n_parallel = n_workers
+
+    def _close_remote(self):
+        if self.remote is not None:
+            self.remote.close()
+            for process in getattr(self.remote, "local_workers", []):
+                process.wait()
+            self.remote = None
+            self.G = SharedGlobal()
+
     def run_each(self, runner, args_list=None):
         """
         Run the method on each worker process, and collect the result of execution.
@@ -73,6 +149,8 @@ class StatefulPool(object):
         if args_list is None:
             args_list = [tuple()] * self.n_parallel
         assert len(args_list) == self.n_parallel
+        if self.remote is not None:
+            return self.remote.run_each(runner, args_list)
         if self.n_parallel > 1:
             results = self.pool.map_async(
                 _worker_run_each, [(runner, args) for args in args_list]
@@ -85,6 +163,8 @@ class StatefulPool(object):
         return [runner(self.G, *args_list[0])]
 
     def run_map(self, runner, args_list):
+        if self.remote is not None:
+            return self.remote.run_map(runner, args_list)
         if self.n_parallel > 1:
             return self.pool.map(_worker_run_map, [(runner, args) for args in args_list])
         else:
@@ -94,7 +174,10 @@ class StatefulPool(object):
             return ret
 
     def run_imap_unordered(self, runner, args_list):
-        if self.n_parallel > 1:
+        if self.remote is not None:
+            for _, x in self.remote.run_imap_unordered(runner, args_list):
+                yield x
+        elif self.n_parallel > 1:
             for x in self.pool.imap_unordered(_worker_run_map, [(runner, args) for args in args_list]):
                 yield x
         else:
@@ -115,13 +198,37 @@ class StatefulPool(object):
 
         stateful_pool.run_collect(collect_once, threshold=3) # => ['a', 'a', 'a']
 
+        The bookkeeping used with a worker pool is selected by self.collect_mode (see __init__).
+
         :param collector:
         :param threshold:
         :return:
         """
+        return self.run_collect_async(collect_once, threshold, args=args, show_prog_bar=show_prog_bar).get()
+
+    def run_collect_async(self, collect_once, threshold, args=None, show_prog_bar=True):
+        """
+        Same as run_collect, but return a CollectHandle right away instead of the collected objects. With a worker
+        pool the workers start collecting immediately, so the caller can keep working until it calls get() on the
+        handle. Without a pool, the collection is deferred until get() is called. No other method of the pool should
+        be used before get() has returned.
+        """
         if args is None:
             args = tuple()
-        if self.pool:
+        if self.remote is not None:
+            pbar = ProgBarCounter(threshold) if show_prog_bar else None
+            thread = self.remote.run_collect_async(
+                collect_once, threshold, args, progress=pbar.inc if show_prog_bar else None
+            )
+
+            def wait():
+                out = thread.get()
+                if show_prog_bar:
+                    pbar.stop()
+                print('Done sampling.')
+                return out
+            return CollectHandle(wait)
+        elif self.pool and self.collect_mode == "manager":
             manager = mp.Manager()
             counter = manager.Value('i', 0)
             lock = manager.RLock()
@@ -129,39 +236,70 @@ class StatefulPool(object):
                 _worker_run_collect,
                 [(collect_once, counter, lock, threshold, args)] * self.n_parallel
             )
-            if show_prog_bar:
-                pbar = ProgBarCounter(threshold)
-            last_value = 0
-            while True:
-                time.sleep(0.1)
-                with lock:
-                    if counter.value >= threshold:
+
+            def wait():
+                if show_prog_bar:
+                    pbar = ProgBarCounter(threshold)
+                last_value = 0
+                while True:
+                    time.sleep(0.1)
+                    with lock:
+                        if counter.value >= threshold:
+                            if show_prog_bar:
+                                pbar.stop()
+                            break
                         if show_prog_bar:
-                            pbar.stop()
-                        break
+                            pbar.inc(counter.value - last_value)
+                        last_value = counter.value
+                return self._get_collect_results(results)
+            return CollectHandle(wait)
+        elif self.pool:
+            self.counter.value = 0
+            self.collect_done.clear()
+            results = self.pool.map_async(
+                _worker_run_collect_shared,
+                [(collect_once, threshold, args)] * self.n_parallel
+            )
+
+            def wait():
+                if show_prog_bar:
+                    pbar = ProgBarCounter(threshold)
+                last_value = 0
+                # the timeout only paces the progress bar; the master wakes up as soon as the threshold is reached.
+                # results.ready() guards against waiting forever if all the workers died before reaching it
+                while not self.collect_done.wait(0.1) and not results.ready():
                     if show_prog_bar:
-                        pbar.inc(counter.value - last_value)
-                    last_value = counter.value
-            print('Done sampling.')
-            start = time.time()
-            out = sum(results.get(), [])
-            stop = time.time()
-            print('Returning results ({} sec).'.format(stop - start))
-            return out
+                        value = self.counter.value
+                        pbar.inc(value - last_value)
+                        last_value = value
+                if show_prog_bar:
+                    pbar.stop()
+                return self._get_collect_results(results)
+            return CollectHandle(wait)
         else:
-            count = 0
-            results = []
-            if show_prog_bar:
-                pbar = ProgBarCounter(threshold)
-            while count < threshold:
-                result, inc = collect_once(self.G, *args)
-                results.append(result)
-                count += inc
+            def collect():
+                count = 0
+                results = []
                 if show_prog_bar:
-                    pbar.inc(inc)
-            if show_prog_bar:
-                pbar.stop()
-            return results
+                    pbar = ProgBarCounter(threshold)
+                while count < threshold:
+                    result, inc = collect_once(self.G, *args)
+                    results.append(result)
+                    count += inc
+                    if show_prog_bar:
+                        pbar.inc(inc)
+                if show_prog_bar:
+                    pbar.stop()
+                return results
+            return CollectHandle(collect, deferred=True)
+
+    def _get_collect_results(self, results):
+        print('Done sampling.')
+        start = time.time()
+        out = sum(results.get(), [])
+        stop = time.time()
+        print('Returning results ({} sec).'.format(stop - start))
+        return out
 
 
 singleton_pool = StatefulPool()
@@ -197,6 +335,26 @@ def _worker_run_collect(all_args):
         raise Exception("".join(traceback.format_exception(*sys.exc_info())))
 
 
+def _worker_run_collect_shared(all_args):
+    try:
+        collect_once, threshold, args = all_args
+        counter = singleton_pool.counter
+        collected = []
+        while True:
+            if counter.value >= threshold:
+                return collected
+            result, inc = collect_once(singleton_pool.G, *args)
+            collected.append(result)
+            with counter.get_lock():
+                counter.value += inc
+                value = counter.value
+            if value >= threshold:
+                singleton_pool.collect_done.set()
+                return collected
+    except Exception:
+        raise Exception("".join(traceback.format_exception(*sys.exc_info())))
+
+
 def _worker_run_map(all_args):
     try:
         runner, args = all_args
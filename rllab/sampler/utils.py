@@ -3,7 +3,169 @@ from rllab.misc import tensor_utils
 import time
 
 
-def rollout(env, agent, max_path_length=np.inf, animated=False, speedup=1, init_state=None, no_action = False):
+class RolloutTimer(object):
+    """
+    Accumulates the time spent in env.step, agent.get_action and env.reset over the rollouts it is passed to, and
+    the time spent serializing their paths, which the caller adds to serialization.
+    """
+
+    KEYS = ["env_step", "policy", "reset", "serialization"]
+
+    def __init__(self):
+        for key in self.KEYS:
+            setattr(self, key, 0.)
+
+    def wrap(self, env, agent):
+        return (
+            _TimedProxy(env, self, dict(step="env_step", reset="reset")),
+            _TimedProxy(agent, self, dict(get_action="policy")),
+        )
+
+    def as_dict(self):
+        return {key: getattr(self, key) for key in self.KEYS}
+
+
+class _TimedProxy(object):
+    def __init__(self, wrapped, timer, timed_methods):
+        self._wrapped = wrapped
+        self._timer = timer
+        self._timed_methods = timed_methods
+
+    def __getattr__(self, name):
+        attr = getattr(self._wrapped, name)
+        if name not in self._timed_methods:
+            return attr
+        key = self._timed_methods[name]
+        timer = self._timer
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            out = attr(*args, **kwargs)
+            setattr(timer, key, getattr(timer, key) + time.perf_counter() - start)
+            return out
+        return timed
+
+
+class RecordingSpec(object):
+    """
+    Which entries of the env_info and agent_info of each step a rollout records. Entries are named after the dict
+    they come from, e.g. "env_infos/goal" or "agent_infos/mean". An entry can be kept at every step, or summarized
+    on the worker by only keeping its value at the first or the last step, or by reducing it over the steps of the
+    path. The summaries of a path are stored in path["summaries"]["env_infos"] and path["summaries"]["agent_infos"].
+    """
+
+    SECTIONS = ["env_infos", "agent_infos"]
+    REDUCTIONS = dict(sum=np.add, max=np.maximum, min=np.minimum, mean=np.add)
+
+    def __init__(self, per_step=None, first=(), last=(), reduce=None):
+        """
+        :param per_step: entries kept at every step; None keeps all the entries that are not summarized
+        :param first: entries only kept at the first step of the path
+        :param last: entries only kept at the last step of the path
+        :param reduce: dict from an entry to the reduction applied over the steps: "sum", "max", "min" or "mean"
+        """
+        if reduce is None:
+            reduce = dict()
+        for name in reduce.values():
+            assert name in self.REDUCTIONS, "Unknown reduction {}".format(name)
+        self.per_step = None if per_step is None else {section: set() for section in self.SECTIONS}
+        self.summarized = {section: dict() for section in self.SECTIONS}
+        for entry in (per_step or []):
+            section, key = self._split(entry)
+            self.per_step[section].add(key)
+        for mode, entries in [("first", first), ("last", last), ("reduce", reduce)]:
+            for entry in entries:
+                section, key = self._split(entry)
+                assert key not in self.summarized[section], "{} is summarized twice".format(entry)
+                self.summarized[section][key] = reduce[entry] if mode == "reduce" else mode
+
+    def _split(self, entry):
+        section, _, key = entry.partition("/")
+        assert section in self.SECTIONS and key, \
+            "Entries must be named env_infos/<key> or agent_infos/<key>, got {}".format(entry)
+        return section, key
+
+    def keeps(self, section, key):
+        """ Whether the entry is kept at every step. """
+        if self.per_step is None:
+            return key not in self.summarized[section]
+        return key in self.per_step[section]
+
+    def recorder(self):
+        return _InfoRecorder(self)
+
+
+class _InfoRecorder(object):
+    """ Applies a RecordingSpec to the steps of one path. """
+
+    def __init__(self, spec):
+        self.spec = spec
+        self._summaries = {section: dict() for section in spec.SECTIONS}
+        self._counts = {section: dict() for section in spec.SECTIONS}
+
+    def record(self, section, info):
+        """ Update the summaries with the info of a step, and return the entries of the info kept at this step. """
+        summaries = self._summaries[section]
+        counts = self._counts[section]
+        for key, mode in self.spec.summarized[section].items():
+            if key not in info:
+                continue
+            value = np.asarray(info[key])
+            if mode == "first":
+                if key not in summaries:
+                    summaries[key] = value.copy()
+            elif mode == "last":
+                summaries[key] = value.copy()
+            elif key not in summaries:
+                if mode == "mean":
+                    value = value.astype(np.float64)
+                elif mode == "sum" and value.dtype == np.bool_:
+                    # np.add on booleans is a logical or
+                    value = value.astype(np.int64)
+                summaries[key] = value.copy()
+                counts[key] = 1
+            else:
+                summaries[key] = self.spec.REDUCTIONS[mode](summaries[key], value)
+                counts[key] += 1
+        return {k: v for k, v in info.items() if self.spec.keeps(section, k)}
+
+    def summaries(self):
+        summaries = {section: dict(values) for section, values in self._summaries.items()}
+        for section, values in summaries.items():
+            for key, mode in self.spec.summarized[section].items():
+                if mode == "mean" and key in values:
+                    values[key] = values[key] / self._counts[section][key]
+        return summaries
+
+
+def get_path_info(path, key, section="env_infos", step=0):
+    """
+    Value of an env_info (or agent_info) entry at the given step of a path, falling back to its summary when the
+    path was recorded with a RecordingSpec that only kept it at the first (step=0) or the last (step=-1) step.
+    """
+    if key in path.get(section, dict()):
+        return path[section][key][step]
+    return path["summaries"][section][key]
+
+
+def rollout(env, agent, max_path_length=np.inf, animated=False, speedup=1, init_state=None, no_action = False,
+            preallocate=False, timer=None, recording=None):
+    """
+    :param preallocate: write each step in place into arrays allocated after the first step (sized to
+    max_path_length when it is finite) instead of appending to lists and stacking them at the end. The dtype and
+    shape of every array, including each env_info and agent_info entry, are taken from the first step.
+    :param timer: optional RolloutTimer accumulating the time spent in the env and the agent
+    :param recording: optional RecordingSpec selecting the env_info and agent_info entries kept in the path
+    """
+    if timer is not None:
+        env, agent = timer.wrap(env, agent)
+    recorder = recording.recorder() if recording is not None else None
+    if preallocate:
+        path = _preallocated_rollout(env, agent, max_path_length, animated, speedup, init_state, no_action,
+                                     recorder)
+        if recorder is not None:
+            path["summaries"] = recorder.summaries()
+        return path
     observations = []
     actions = []
     rewards = []
@@ -24,6 +186,9 @@ def rollout(env, agent, max_path_length=np.inf, animated=False, speedup=1, init_
         if no_action:
             a = np.zeros_like(a)
         next_o, r, d, env_info = env.step(a)
+        if recorder is not None:
+            agent_info = recorder.record("agent_infos", agent_info)
+            env_info = recorder.record("env_infos", env_info)
         observations.append(env.observation_space.flatten(o))
         rewards.append(r)
         actions.append(env.action_space.flatten(a))
@@ -41,7 +206,7 @@ def rollout(env, agent, max_path_length=np.inf, animated=False, speedup=1, init_
     if animated:
         env.render(close=False)
 
-    return dict(
+    path = dict(
         observations=tensor_utils.stack_tensor_list(observations),
         actions=tensor_utils.stack_tensor_list(actions),
         rewards=tensor_utils.stack_tensor_list(rewards),
@@ -50,3 +215,185 @@ def rollout(env, agent, max_path_length=np.inf, animated=False, speedup=1, init_
         dones=np.asarray(dones),
         last_obs=o,
     )
+    if recorder is not None:
+        path["summaries"] = recorder.summaries()
+    return path
+
+
+def _alloc_step_buffer(value, capacity):
+    if isinstance(value, dict):
+        return {k: _alloc_step_buffer(v, capacity) for k, v in value.items()}
+    value = np.asarray(value)
+    return np.empty((capacity,) + value.shape, dtype=value.dtype)
+
+
+def _write_step(buffer, value, t):
+    """
+    Write the value of step t into the buffer. The buffer is upcast (copied) when the value does not fit its dtype,
+    e.g. an env_info that is an int at the first step and a float later, as stacking the steps would do.
+    :return: the buffer, or the upcast one
+    """
+    if isinstance(buffer, dict):
+        # like stack_tensor_dict_list, only the keys present at the first step are kept
+        for k, v in buffer.items():
+            buffer[k] = _write_step(v, value[k], t)
+        return buffer
+    value = np.asarray(value)
+    dtype = np.result_type(buffer.dtype, value.dtype)
+    if dtype != buffer.dtype:
+        buffer = buffer.astype(dtype)
+    buffer[t] = value
+    return buffer
+
+
+def _resize_step_buffer(buffer, size):
+    if isinstance(buffer, dict):
+        return {k: _resize_step_buffer(v, size) for k, v in buffer.items()}
+    if size == len(buffer):
+        return buffer
+    if size < len(buffer):
+        # copy so that the unused capacity is released
+        return buffer[:size].copy()
+    grown = np.empty((size,) + buffer.shape[1:], dtype=buffer.dtype)
+    grown[:len(buffer)] = buffer
+    return grown
+
+
+def _preallocated_rollout(env, agent, max_path_length, animated, speedup, init_state, no_action, recorder=None):
+    if init_state is not None:
+        o = env.reset(init_state)
+    else:
+        o = env.reset()
+    agent.reset()
+    path = None
+    capacity = max_path_length if np.isfinite(max_path_length) else 1024
+    path_length = 0
+    if animated:
+        env.render()
+    while path_length < max_path_length:
+        a, agent_info = agent.get_action(o)
+        if no_action:
+            a = np.zeros_like(a)
+        next_o, r, d, env_info = env.step(a)
+        if recorder is not None:
+            agent_info = recorder.record("agent_infos", agent_info)
+            env_info = recorder.record("env_infos", env_info)
+        step = dict(
+            observations=env.observation_space.flatten(o),
+            actions=env.action_space.flatten(a),
+            rewards=r,
+            agent_infos=agent_info,
+            env_infos=env_info,
+            dones=d,
+        )
+        if path is None:
+            path = _alloc_step_buffer(step, int(capacity))
+            path["rewards"] = np.empty(int(capacity))
+            path["dones"] = np.empty(int(capacity), dtype=bool)
+        elif path_length == capacity:
+            capacity *= 2
+            path = _resize_step_buffer(path, capacity)
+        path = _write_step(path, step, path_length)
+        path_length += 1
+        if d:
+            break
+        o = next_o
+        if animated:
+            env.render()
+            timestep = 0.05
+            time.sleep(timestep / speedup)
+    if animated:
+        env.render(close=False)
+
+    path = _resize_step_buffer(path, path_length)
+    path["last_obs"] = o
+    return path
+
+
+def vectorized_rollout(envs, agent, max_path_length=np.inf, max_samples=None, n_paths=None, reset_hook=None,
+                       recording=None):
+    """
+    Roll out the agent on several copies of an environment in lockstep, with a single agent.get_actions call per
+    step for all the running copies. A slot whose path terminates emits its path and is reset to start a new one as
+    long as more paths are needed; otherwise it stays idle until the other slots are done.
+    :param envs: list of environment copies, one per slot
+    :param agent: a non-recurrent policy implementing get_actions
+    :param max_path_length: horizon / maximum length of a single trajectory
+    :param max_samples: stop starting new paths once the finished paths plus the running ones hold this many samples
+    :param n_paths: stop starting new paths once this many paths have been started
+    :param reset_hook: optional callable(env, path_idx) called before an env is reset to start path number path_idx
+    :param recording: optional RecordingSpec selecting the env_info and agent_info entries kept in the paths
+    :return: the list of finished paths, ordered by the index in which they were started
+    """
+    assert not getattr(agent, "recurrent", False), "vectorized_rollout does not support recurrent policies"
+    assert max_samples is not None or n_paths is not None, "either max_samples or n_paths has to be specified"
+    n_envs = len(envs)
+    finished_paths = dict()
+    running = [None] * n_envs
+    obs = [None] * n_envs
+    n_started = 0
+    n_finished_samples = 0
+
+    def need_more_paths():
+        if n_paths is not None and n_started >= n_paths:
+            return False
+        if max_samples is not None:
+            running_samples = sum(len(buf["rewards"]) for buf in running if buf is not None)
+            return n_finished_samples + running_samples < max_samples
+        return True
+
+    def start_path(slot):
+        if reset_hook is not None:
+            reset_hook(envs[slot], n_started)
+        obs[slot] = envs[slot].reset()
+        running[slot] = dict(path_idx=n_started, observations=[], actions=[], rewards=[], agent_infos=[],
+                             env_infos=[], dones=[])
+        if recording is not None:
+            running[slot]["recorder"] = recording.recorder()
+
+    agent.reset()
+    for slot in range(n_envs):
+        if not need_more_paths():
+            break
+        start_path(slot)
+        n_started += 1
+
+    while any(buf is not None for buf in running):
+        active = [slot for slot in range(n_envs) if running[slot] is not None]
+        actions, agent_infos = agent.get_actions([obs[slot] for slot in active])
+        for i, slot in enumerate(active):
+            env = envs[slot]
+            buf = running[slot]
+            o = obs[slot]
+            a = actions[i]
+            next_o, r, d, env_info = env.step(a)
+            agent_info = {k: v[i] for k, v in agent_infos.items()}
+            if recording is not None:
+                agent_info = buf["recorder"].record("agent_infos", agent_info)
+                env_info = buf["recorder"].record("env_infos", env_info)
+            buf["observations"].append(env.observation_space.flatten(o))
+            buf["rewards"].append(r)
+            buf["actions"].append(env.action_space.flatten(a))
+            buf["agent_infos"].append(agent_info)
+            buf["env_infos"].append(env_info)
+            buf["dones"].append(d)
+            obs[slot] = next_o
+            if d or len(buf["rewards"]) >= max_path_length:
+                finished_paths[buf["path_idx"]] = dict(
+                    observations=tensor_utils.stack_tensor_list(buf["observations"]),
+                    actions=tensor_utils.stack_tensor_list(buf["actions"]),
+                    rewards=tensor_utils.stack_tensor_list(buf["rewards"]),
+                    agent_infos=tensor_utils.stack_tensor_dict_list(buf["agent_infos"]),
+                    env_infos=tensor_utils.stack_tensor_dict_list(buf["env_infos"]),
+                    dones=np.asarray(buf["dones"]),
+                    last_obs=o if d else next_o,
+                )
+                if recording is not None:
+                    finished_paths[buf["path_idx"]]["summaries"] = buf["recorder"].summaries()
+                n_finished_samples += len(buf["rewards"])
+                running[slot] = None
+                if need_more_paths():
+                    start_path(slot)
+                    n_started += 1
+
+    return [finished_paths[idx] for idx in sorted(finished_paths.keys())]
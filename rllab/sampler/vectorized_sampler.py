@@ -0,0 +1,100 @@
+import numpy as np
+# import pickle
+import cloudpickle as pickle
+
+from rllab.sampler import parallel_sampler
+from rllab.sampler.base import BaseSampler
+from rllab.sampler.path_batch import PathBatch
+from rllab.sampler.stateful_pool import singleton_pool
+from rllab.sampler.utils import vectorized_rollout
+
+
+def _worker_init_vec_envs(G, n_envs, scope=None):
+    G = parallel_sampler._get_scoped_G(G, scope)
+    # the populated env is used as the first slot, the others are copies of it
+    G.vec_envs = [G.env] + [pickle.loads(pickle.dumps(G.env)) for _ in range(n_envs - 1)]
+
+
+def _worker_terminate_vec_envs(G, scope=None):
+    G = parallel_sampler._get_scoped_G(G, scope)
+    if getattr(G, "vec_envs", None):
+        for env in G.vec_envs[1:]:
+            env.terminate()
+        G.vec_envs = None
+
+
+def _worker_collect_vec_paths(G, max_path_length, max_samples, scope=None, params_channel=None,
+                              path_transport=None):
+    G = parallel_sampler._get_scoped_G(G, scope)
+    parallel_sampler._worker_sync_policy_params(G, params_channel)
+    paths = vectorized_rollout(G.vec_envs, G.policy, max_path_length, max_samples=max_samples)
+    n_samples = sum(len(path["rewards"]) for path in paths)
+    if path_transport is not None:
+        paths = [path_transport.write(path) for path in paths]
+    return paths, n_samples
+
+
+class VectorizedSampler(BaseSampler):
+    """
+    Sampler that keeps n_envs copies of the environment on each worker and steps them in lockstep, so that the
+    policy is queried once per step for all the copies through policy.get_actions.
+    """
+
+    def __init__(self, algo, n_envs=None, shared_transport=False, persistent_workers=False):
+        """
+        :type algo: BatchPolopt
+        :param n_envs: number of environment copies per worker. By default it is chosen so that one lockstep
+        rollout per worker roughly fills the batch.
+        :param shared_transport: send the paths from the workers back to the master through shared memory instead
+        of pickling them
+        :param persistent_workers: keep the env and policy on the workers when shutting down, so that the next
+        algorithm using the same scope only sends what changed (see parallel_sampler.populate_task)
+        """
+        super(VectorizedSampler, self).__init__(algo)
+        self.n_envs = n_envs
+        self.shared_transport = shared_transport
+        self.persistent_workers = persistent_workers
+
+    def start_worker(self):
+        if self.n_envs is None:
+            n_envs = int(self.algo.batch_size / self.algo.max_path_length / singleton_pool.n_parallel)
+            self.n_envs = max(1, min(n_envs, 100))
+        parallel_sampler.populate_task(self.algo.env, self.algo.policy, scope=self.algo.scope)
+        singleton_pool.run_each(
+            _worker_init_vec_envs,
+            [(self.n_envs, self.algo.scope)] * singleton_pool.n_parallel
+        )
+
+    def shutdown_worker(self):
+        singleton_pool.run_each(
+            _worker_terminate_vec_envs,
+            [(self.algo.scope,)] * singleton_pool.n_parallel
+        )
+        parallel_sampler.terminate_task(scope=self.algo.scope, persistent=self.persistent_workers)
+
+    def obtain_samples(self, itr):
+        return self.obtain_samples_async(itr).get()
+
+    def obtain_samples_async(self, itr):
+        cur_params = self.algo.policy.get_param_values()
+        params_channel = parallel_sampler.broadcast_policy_params(cur_params, scope=self.algo.scope)
+        path_transport = parallel_sampler.get_path_transport(self.algo.scope) if self.shared_transport else None
+        samples_per_call = int(np.ceil(self.algo.batch_size / singleton_pool.n_parallel))
+        handle = singleton_pool.run_collect_async(
+            _worker_collect_vec_paths,
+            threshold=self.algo.batch_size,
+            args=(self.algo.max_path_length, samples_per_call, self.algo.scope, params_channel, path_transport),
+            show_prog_bar=True
+        )
+        return handle.then(lambda results: self._postprocess(results, path_transport))
+
+    def _postprocess(self, results, path_transport):
+        paths = [path for worker_paths in results for path in worker_paths]
+        if path_transport is not None:
+            paths = path_transport.read(paths)
+        paths = PathBatch.from_paths(paths)
+        if self.algo.whole_paths:
+            return paths
+        else:
+            paths_truncated = parallel_sampler.truncate_paths(paths, self.algo.batch_size)
+            return paths_truncated
@@ -0,0 +1,45 @@
+"""
+Benchmark the bookkeeping overhead of StatefulPool.run_collect, comparing the Manager-proxy implementation with
+the shared-memory counter. The collector emulates short rollouts by sleeping for a fixed time per path.
+"""
+import argparse
+import time
+
+import numpy as np
+
+from rllab.sampler.stateful_pool import singleton_pool
+
+
+def _collect_once(G, path_length, step_time):
+    if step_time > 0:
+        time.sleep(path_length * step_time)
+    return None, path_length
+
+
+def benchmark(mode, threshold, path_length, step_time, n_repeats):
+    singleton_pool.collect_mode = mode
+    timings = []
+    for _ in range(n_repeats):
+        start = time.time()
+        singleton_pool.run_collect(_collect_once, threshold, args=(path_length, step_time), show_prog_bar=False)
+        timings.append(time.time() - start)
+    return timings
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_parallel', type=int, default=8, help='number of worker processes')
+    parser.add_argument('--threshold', type=int, default=20000, help='number of samples to collect per call')
+    parser.add_argument('--path_length', type=int, default=20, help='samples per collected path')
+    parser.add_argument('--step_time', type=float, default=1e-5, help='emulated time per env step, in seconds')
+    parser.add_argument('--n_repeats', type=int, default=10, help='number of run_collect calls per mode')
+    args = parser.parse_args()
+
+    singleton_pool.initialize(args.n_parallel)
+    for mode in ["manager", "shared"]:
+        # warm up the workers before timing
+        benchmark(mode, args.threshold, args.path_length, args.step_time, 1)
+        timings = benchmark(mode, args.threshold, args.path_length, args.step_time, args.n_repeats)
+        print("{}: mean {:.4f} sec, min {:.4f} sec per run_collect ({} paths of {} samples, {} workers)".format(
+            mode, np.mean(timings), np.min(timings), args.threshold // args.path_length, args.path_length,
+            args.n_parallel))
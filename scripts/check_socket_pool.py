@@ -0,0 +1,78 @@
+"""
+Check the socket backend of StatefulPool on this machine: start the workers as local subprocesses, run each method
+of the pool contract, and make sure that a failing task or collection leaves the pool usable for the next call.
+"""
+import argparse
+
+from rllab.sampler.socket_pool import RemoteWorkerError
+from rllab.sampler.stateful_pool import singleton_pool
+
+
+def _worker_id(G):
+    return G.socket_worker_id
+
+
+def _double(G, x):
+    return 2 * x
+
+
+def _fail(G, x):
+    if x % 2 == 1:
+        raise ValueError("task {} failed".format(x))
+    return x
+
+
+def _collect_once(G, path_length):
+    return G.socket_worker_id, path_length
+
+
+def _collect_fail(G, path_length):
+    if G.socket_worker_id == 0:
+        raise ValueError("collection failed")
+    return G.socket_worker_id, path_length
+
+
+def _expect_error(method, *args):
+    try:
+        method(*args)
+    except RemoteWorkerError:
+        return
+    raise AssertionError("{} did not raise RemoteWorkerError".format(method.__name__))
+
+
+def check(n_workers, n_tasks, threshold, path_length):
+    assert sorted(singleton_pool.run_each(_worker_id)) == list(range(n_workers))
+    args_list = [(x,) for x in range(n_tasks)]
+    assert singleton_pool.run_map(_double, args_list) == [2 * x for x in range(n_tasks)]
+    assert sorted(singleton_pool.run_imap_unordered(_double, args_list)) == [2 * x for x in range(n_tasks)]
+
+    # the replies of the tasks still running when a task fails must not be read by the next call
+    _expect_error(singleton_pool.run_map, _fail, args_list)
+    assert singleton_pool.run_map(_double, args_list) == [2 * x for x in range(n_tasks)]
+    _expect_error(singleton_pool.run_each, _fail, [(x,) for x in range(n_workers)])
+    assert sorted(singleton_pool.run_each(_worker_id)) == list(range(n_workers))
+
+    collected = singleton_pool.run_collect(_collect_once, threshold, args=(path_length,), show_prog_bar=False)
+    assert len(collected) * path_length >= threshold
+
+    # the other workers must be stopped when one of them fails
+    _expect_error(singleton_pool.run_collect, _collect_fail, threshold, (path_length,), False)
+    collected = singleton_pool.run_collect(_collect_once, threshold, args=(path_length,), show_prog_bar=False)
+    assert len(collected) * path_length >= threshold
+    assert singleton_pool.run_map(_double, args_list) == [2 * x for x in range(n_tasks)]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_workers', type=int, default=4, help='number of local worker processes')
+    parser.add_argument('--n_tasks', type=int, default=20, help='number of tasks per run_map call')
+    parser.add_argument('--threshold', type=int, default=1000, help='number of samples to collect per call')
+    parser.add_argument('--path_length', type=int, default=10, help='samples per collected path')
+    args = parser.parse_args()
+
+    singleton_pool.initialize_socket(args.n_workers, launch_local=True)
+    try:
+        check(args.n_workers, args.n_tasks, args.threshold, args.path_length)
+    finally:
+        singleton_pool.initialize(1)
+    print("The socket pool passed all the checks with {} workers.".format(args.n_workers))
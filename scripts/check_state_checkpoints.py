@@ -0,0 +1,86 @@
+"""
+Check the on-disk format of StateCollection.checkpoint / load_state_collection in a temporary directory: repeated
+checkpoints with and without new states, appends to a loaded collection, and rewrites after an eviction, including
+one interrupted before its header was written.
+"""
+import argparse
+import shutil
+import tempfile
+import os.path as osp
+
+import numpy as np
+
+from curriculum.state import utils
+from curriculum.state.utils import StateCollection, load_state_collection
+
+
+def _transform(states):
+    return states[:, :2]
+
+
+def _check_loads(prefix, collection):
+    for mmap in [True, False]:
+        loaded = load_state_collection(prefix, states_transform=_transform, mmap=mmap)
+        assert np.array_equal(loaded.state_list, collection.state_list)
+        assert np.array_equal(loaded.transformed_state_list, collection.transformed_state_list)
+
+
+def check(directory, n_states, state_dim):
+    prefix = osp.join(directory, 'states')
+    collection = StateCollection(distance_threshold=0.01, states_transform=_transform, max_size=2 * n_states)
+    collection.append(np.random.rand(n_states, state_dim))
+    collection.checkpoint(prefix)
+    _check_loads(prefix, collection)
+
+    # nothing was added since the last checkpoint, the files must be kept as they are
+    collection.checkpoint(prefix)
+    _check_loads(prefix, collection)
+    collection.append(collection.state_list[:1])
+    collection.checkpoint(prefix)
+    _check_loads(prefix, collection)
+
+    # a loaded collection appends to the same files
+    loaded = load_state_collection(prefix, states_transform=_transform)
+    loaded.append(np.random.rand(n_states // 2, state_dim) + 2)
+    loaded.checkpoint(prefix)
+    _check_loads(prefix, loaded)
+
+    # the collection is full: the eviction makes the next checkpoint rewrite all the states
+    collection = loaded
+    collection.max_size = 2 * n_states
+    collection.append(np.random.rand(n_states, state_dim) + 4)
+    collection.checkpoint(prefix)
+    _check_loads(prefix, collection)
+
+    # a rewrite interrupted before the header is written leaves the previous checkpoint readable
+    saved = load_state_collection(prefix, states_transform=_transform, mmap=False)
+    collection.append(np.random.rand(n_states, state_dim) + 6)
+    write_header = utils._write_header
+
+    def interrupted(*args):
+        raise KeyboardInterrupt
+
+    utils._write_header = interrupted
+    try:
+        collection.checkpoint(prefix)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        utils._write_header = write_header
+    _check_loads(prefix, saved)
+    collection.checkpoint(prefix)
+    _check_loads(prefix, collection)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_states', type=int, default=100, help='number of states appended at a time')
+    parser.add_argument('--state_dim', type=int, default=4, help='dimension of the states')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        check(directory, args.n_states, args.state_dim)
+    finally:
+        shutil.rmtree(directory)
+    print("The state collection checkpoints passed all the checks.")